@@ -3,16 +3,39 @@ import os
 for _k in ("HTTP_PROXY","HTTPS_PROXY","ALL_PROXY","http_proxy","https_proxy","all_proxy"):
     os.environ.pop(_k, None)
 
-import re, io, time, asyncio, textwrap
+import re, io, json, time, asyncio, contextlib, hashlib, importlib, unicodedata, zlib
+
+class BootTimer:
+    # отметки времени от старта процесса: где уходят секунды холодного старта
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.marks: list[tuple[str, float]] = []
+        self.first_update_seen = False
+
+    def mark(self, name: str):
+        self.marks.append((name, time.perf_counter() - self.t0))
+
+    def first_update(self):
+        if not self.first_update_seen:
+            self.first_update_seen = True
+            self.mark("first_update"); self.report()
+
+    def report(self):
+        print("[BOOT] " + " ".join(f"{name}={t * 1000:.0f}ms" for name, t in self.marks))
+
+BOOT = BootTimer()
+from collections import OrderedDict, deque
 import aiosqlite
 from typing import Optional, Callable, Awaitable
 
 from telegram import Update, LabeledPrice, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ParseMode, ChatAction
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application, ApplicationBuilder, ContextTypes,
     CommandHandler, MessageHandler, CallbackQueryHandler,
-    PreCheckoutQueryHandler, filters
+    PreCheckoutQueryHandler, BaseRateLimiter, BaseUpdateProcessor, filters
 )
 
 # ---------- ENV ----------
@@ -26,6 +49,11 @@ if not PUBLIC_URL:
     raise RuntimeError("RENDER_EXTERNAL_URL (или PUBLIC_URL) не задан")
 PORT = int(os.getenv("PORT") or 8080)
 
+# Несколько процессов: фронт на PORT раздаёт апдейты воркерам по chat_id (см. «Multi-process mode»)
+WEB_WORKERS      = max(1, int(os.getenv("WEB_WORKERS", "1")))
+WORKER_INDEX     = int(os.getenv("WORKER_INDEX", "-1"))        # ставит фронт; -1 — одиночный процесс или сам фронт
+WORKER_PORT_BASE = int(os.getenv("WORKER_PORT_BASE") or PORT + 1)
+
 # Stars
 PRICE_DAY   = int(os.getenv("PREMIUM_DAY",   "199"))
 PRICE_WEEK  = int(os.getenv("PREMIUM_WEEK",  "399"))
@@ -38,97 +66,407 @@ PROVIDER_TOKEN = ""   # не нужен для Stars
 FREE_TEXTS_PER_DAY  = 10
 FREE_PHOTOS_PER_DAY = 5
 
-DB_PATH = "bot.sqlite3"
+DB_PATH = os.getenv("DB_PATH", "bot.sqlite3")
+
+# ---------- Metrics ----------
+import contextvars
+
+# границы бакетов гистограмм, сек.: от миллисекундных запросов к БД до долгих ответов модели
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SLOW_UPDATE_SEC = float(os.getenv("SLOW_UPDATE_SEC", "0"))   # 0 — лог медленных апдейтов выключен
+
+class Metrics:
+    # минимальный реестр в формате Prometheus: счётчики и гистограммы с метками,
+    # плюс gauge-коллбэки, которые читаются только при скрейпе
+    def __init__(self):
+        self._counters: dict[tuple, float] = {}
+        self._hist: dict[tuple, list] = {}          # key -> [bucket counts..., sum, count]
+        self._gauges: list[Callable[[], dict[str, float]]] = []
+
+    def _key(self, name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        k = self._key(name, labels)
+        self._counters[k] = self._counters.get(k, 0) + value
+
+    def observe(self, name: str, sec: float, **labels):
+        k = self._key(name, labels)
+        h = self._hist.get(k)
+        if h is None:
+            h = self._hist[k] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, b in enumerate(LATENCY_BUCKETS):
+            if sec <= b:
+                h[i] += 1
+                break
+        h[-2] += sec; h[-1] += 1
+
+    def gauges(self, fn: Callable[[], dict[str, float]]):
+        self._gauges.append(fn)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, **labels):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t
+            self.observe(f"{stage}_seconds", dt, **labels)
+            trace = _TRACE.get()
+            if trace is not None:
+                trace[stage] = trace.get(stage, 0.0) + dt
+
+    @staticmethod
+    def _labels(items, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in items]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        out = []; typed = set()
+        def type_line(name: str, kind: str):
+            if name not in typed:
+                typed.add(name); out.append(f"# TYPE gdz_{name} {kind}")
+        for (name, labels), v in sorted(self._counters.items()):
+            type_line(name, "counter")
+            out.append(f"gdz_{name}{self._labels(labels)} {v}")
+        for (name, labels), h in sorted(self._hist.items()):
+            type_line(name, "histogram")
+            acc = 0
+            for b, n in zip(LATENCY_BUCKETS, h):
+                acc += n
+                le = self._labels(labels, 'le="%s"' % b)
+                out.append(f"gdz_{name}_bucket{le} {acc}")
+            le = self._labels(labels, 'le="+Inf"')
+            out.append(f"gdz_{name}_bucket{le} {h[-1]}")
+            out.append(f"gdz_{name}_sum{self._labels(labels)} {h[-2]:.6f}")
+            out.append(f"gdz_{name}_count{self._labels(labels)} {h[-1]}")
+        for fn in self._gauges:
+            for name, v in fn().items():
+                type_line(name, "counter" if name.endswith("_total") else "gauge")
+                out.append(f"gdz_{name} {v}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+# стадии текущего апдейта для лога медленных запросов (задачи, созданные в хендлере, пишут сюда же)
+_TRACE: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("trace", default=None)
+
+def traced(name: str, handler):
+    async def wrapper(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        trace: dict[str, float] = {}
+        token = _TRACE.set(trace)
+        t = time.perf_counter()
+        try:
+            return await handler(update, ctx)
+        finally:
+            dt = time.perf_counter() - t
+            _TRACE.reset(token)
+            METRICS.observe("handler_seconds", dt, handler=name)
+            BOOT.first_update()
+            if SLOW_UPDATE_SEC and dt >= SLOW_UPDATE_SEC:
+                stages = " ".join(f"{k}={v * 1000:.0f}ms" for k, v in sorted(trace.items(), key=lambda kv: -kv[1]))
+                print(f"[SLOW] {name} {dt * 1000:.0f}ms update={update.update_id} {stages}")
+    return wrapper
+
+BOOT.mark("imports")
 
 # ---------- OpenAI ----------
-from openai import OpenAI, RateLimitError
+# сам пакет openai импортируется ~0.7 с — клиент создаётся при первом запросе
+# (или фоном после старта), а не при загрузке модуля
 import httpx
-oai_client: Optional[OpenAI] = None
-if OPENAI_API_KEY:
-    _http = httpx.Client(timeout=40.0)
-    oai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=_http)
-
-# ---------- Pretty PNG renderer (wide, no $) ----------
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-
-F_FRACTION = re.compile(r'(?<![\w\\])([A-Za-z0-9]+)\s*/\s*([A-Za-z0-9]+)(?![\w\\])')
-def _to_math_fractions(s: str) -> str:
-    #  a/b  -> \frac{a}{b}
-    return F_FRACTION.sub(r'\\frac{\1}{\2}', s)
-
-def _latexish_cleanup(s: str) -> str:
-    # убрать все видимые $ и окружения \[ \]
-    s = s.replace("\\[","").replace("\\]","").replace("\\(","").replace("\\)","")
-    s = s.replace("$$","").replace("$","")
-    return s
-
-def _normalize_ops(line: str) -> str:
-    return (line
-            .replace("\\cdot","·")
-            .replace("\\times","×")
-            .replace("*","·")
-            .replace("/", "÷")  # простое деление в текстовых линиях
-            .replace(">=", "≥").replace("<=", "≤")
+
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "32"))   # одновременных запросов к модели
+OPENAI_TIMEOUT     = float(os.getenv("OPENAI_TIMEOUT", "40"))     # сек. на один запрос
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "256"))  # апдейтов в обработке одновременно
+
+oai_client = None   # AsyncOpenAI, см. _get_oai
+
+def _get_oai():
+    global oai_client
+    if oai_client is None and OPENAI_API_KEY:
+        from openai import AsyncOpenAI
+        # keep-alive пул соединений: не открываем TLS заново на каждый запрос
+        _http = httpx.AsyncClient(
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=OPENAI_CONCURRENCY,
+                max_keepalive_connections=OPENAI_CONCURRENCY,
+                keepalive_expiry=60.0,
+            ),
+        )
+        oai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=_http, max_retries=1)
+    return oai_client
+
+async def warm_openai():
+    # импорт в потоке, чтобы не держать event loop; клиент собираем уже в loop
+    await asyncio.to_thread(importlib.import_module, "openai")
+    _get_oai()
+    BOOT.mark("openai_ready")
+
+def _is_rate_limit(e: Exception) -> bool:
+    from openai import RateLimitError   # исключение пришло из openai — модуль уже загружен
+    return isinstance(e, RateLimitError)
+
+# не больше OPENAI_CONCURRENCY запросов «в полёте», остальные ждут здесь, а не в httpx-пуле
+_oai_slots = asyncio.Semaphore(OPENAI_CONCURRENCY)
+
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "1") != "0"
+
+ProgressFn = Callable[[str], None]
+
+class EmptyAnswer(Exception):
+    pass
+
+async def _chat_completion(on_progress: Optional[ProgressFn] = None, **kwargs) -> tuple[str, Optional[str]]:
+    # -> (текст, finish_reason). Слот держится до конца стрима, иначе лимит
+    # OPENAI_CONCURRENCY ничего бы не ограничивал. Пустой ответ — ошибка, а не ответ
+    with METRICS.timer("openai_wait"):
+        await _oai_slots.acquire()
+    try:
+        with METRICS.timer("openai"):
+            client = _get_oai()
+            if not (OPENAI_STREAM and on_progress):
+                resp = await client.chat.completions.create(timeout=OPENAI_TIMEOUT, **kwargs)
+                text, finish = (resp.choices[0].message.content or "").strip(), resp.choices[0].finish_reason
+            else:
+                stream = await client.chat.completions.create(timeout=OPENAI_TIMEOUT, stream=True, **kwargs)
+                parts: list[str] = []; finish = None
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    if choice.delta and choice.delta.content:
+                        parts.append(choice.delta.content)
+                        on_progress("".join(parts))
+                    if choice.finish_reason:
+                        finish = choice.finish_reason
+                text = "".join(parts).strip()
+            if not text:
+                raise EmptyAnswer(finish or "no content")
+            return text, finish
+    except Exception as e:
+        METRICS.inc("openai_errors_total", error=type(e).__name__)
+        raise
+    finally:
+        _oai_slots.release()
+
+# ---------- Pretty PNG renderer (пул процессов) ----------
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import renderer
+
+def _available_cpus() -> int:
+    # os.cpu_count() в контейнере — ядра хоста; учитываем affinity и квоту cgroup v2
+    n = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    with contextlib.suppress(OSError, ValueError):
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            n = min(n, max(1, int(quota) // int(period)))
+    return n
+
+# по умолчанию — немного: каждый воркер рендера это отдельный процесс с Pillow (и matplotlib,
+# если попалась mathtext-строка); ядра делятся между веб-воркерами
+RENDER_WORKERS_MAX = int(os.getenv("RENDER_WORKERS_MAX", "2"))
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS") or
+                     max(1, min(RENDER_WORKERS_MAX, (_available_cpus() - WEB_WORKERS) // WEB_WORKERS)))
+RENDER_QUEUE   = int(os.getenv("RENDER_QUEUE", "64"))      # максимум картинок в очереди + в работе
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "30"))
+
+class RenderBusy(Exception):
+    pass
+
+class RenderPool:
+    # matplotlib живёт только в воркерах: настраивается один раз при старте процесса,
+    # event loop лишь ждёт future
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._warm_task: Optional[asyncio.Task] = None
+
+    def _ensure_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            ctx = multiprocessing.get_context("forkserver")
+            # app.py импортируется один раз в forkserver, воркеры форкаются уже готовыми
+            ctx.set_forkserver_preload(["__main__", "renderer"])
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=ctx, initializer=renderer._init_worker,
             )
+        return self._pool
 
-def render_answer_png(text: str) -> bytes:
-    # чистим, ставим \frac, аккуратно оборачиваем math-строки в $
-    text = _latexish_cleanup(text)
-    text = _to_math_fractions(text)
-
-    lines = []
-    for raw in text.splitlines():
-        raw = raw.rstrip()
-        if not raw:
-            lines.append("")
-            continue
-        if any(tok in raw for tok in ["\\frac","\\sqrt","^{","_{","\\int","\\sum"]):
-            lines.append(f"${raw}$")  # mathtext
-        else:
-            lines.extend(textwrap.wrap(_normalize_ops(raw), width=86) or [""])
+    async def warm_up(self):
+        pool = self._ensure_pool()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(pool, renderer.ping) for _ in range(self.workers)))
+
+    def warm_up_in_background(self):
+        # post_init работает до Application.start, поэтому обычная asyncio-задача, а не app.create_task
+        self._warm_task = asyncio.get_running_loop().create_task(self.warm_up())
 
-    # широкое полотно; высота — по количеству строк
-    height = max(1.2, 0.55 + 0.30 * len(lines))
-    fig = plt.figure(figsize=(10.5, height), dpi=200)
-    ax = fig.add_axes([0,0,1,1]); ax.axis("off")
+    async def render(self, text: str) -> bytes:
+        if self.pending >= self.max_pending:
+            raise RenderBusy()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                fut = loop.run_in_executor(self._ensure_pool(), renderer.render_png, text)
+                # отмена/таймаут снимает задачу из очереди пула, если она ещё не началась
+                return await asyncio.wait_for(fut, RENDER_TIMEOUT)
+            except BrokenProcessPool:
+                self._pool = None
+                raise
+        finally:
+            self.pending -= 1
 
-    plt.rcParams.update({
-        "font.size": 12,
-        "font.family": "DejaVu Sans",
-        "mathtext.fontset": "dejavusans",
-    })
+    def shutdown(self):
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
 
-    y = 0.96
-    for line in lines:
-        ax.text(0.05, y, line, va="top", ha="left", wrap=True)
-        y -= 0.042
+RENDER_POOL = RenderPool(RENDER_WORKERS, RENDER_QUEUE)
 
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", bbox_inches="tight", pad_inches=0.35)
-    plt.close(fig); buf.seek(0)
-    return buf.getvalue()
+async def render_answer_png(text: str) -> bytes:
+    with METRICS.timer("render"):
+        return await RENDER_POOL.render(text)
+
+class RenderCache:
+    # PNG по хэшу (версия рендерера + текст решения) в LRU с лимитом по байтам и file_id,
+    # который Telegram вернул после первой отправки: повторно — ни рендера, ни загрузки
+    def __init__(self, max_bytes: int, max_file_ids: int):
+        self.max_bytes = max_bytes
+        self.max_file_ids = max_file_ids
+        self._png: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(f"{renderer.RENDERER_VERSION}\x00{text}".encode()).hexdigest()
+
+    def file_id(self, key: str) -> Optional[str]:
+        fid = self._file_ids.get(key)
+        if fid is not None:
+            self._file_ids.move_to_end(key)
+        return fid
+
+    def set_file_id(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+        # file_id надёжнее байтов: PNG больше не нужен
+        png = self._png.pop(key, None)
+        if png is not None:
+            self._bytes -= len(png)
+
+    def forget_file_id(self, key: str):
+        self._file_ids.pop(key, None)
+
+    def _put_png(self, key: str, png: bytes):
+        if len(png) > self.max_bytes:
+            return
+        self._png[key] = png; self._bytes += len(png)
+        while self._bytes > self.max_bytes:
+            _, old = self._png.popitem(last=False)
+            self._bytes -= len(old)
+
+    async def png(self, key: str, text: str) -> bytes:
+        png = self._png.get(key)
+        if png is not None:
+            self._png.move_to_end(key)
+            return png
+        fut = self._inflight.get(key)
+        if fut is not None:              # тот же текст уже рендерится для другого чата
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            png = await render_answer_png(text)
+            fut.set_result(png)
+        except BaseException as e:
+            fut.set_exception(e); fut.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        self._put_png(key, png)
+        return png
+
+RENDER_CACHE = RenderCache(
+    max_bytes=int(float(os.getenv("RENDER_CACHE_MB", "64")) * 1024 * 1024),
+    max_file_ids=int(os.getenv("RENDER_CACHE_FILE_IDS", "100000")),
+)
 
 def _escape_html(s: str) -> str:
     return (s or "").replace("&","&amp;").replace("<","&lt;").replace(">","&gt;")
 
-async def _send_typing(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, sec: float=0.8):
-    await ctx.bot.send_chat_action(chat_id, ChatAction.TYPING)
-    await asyncio.sleep(sec)
+async def _send_typing(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    with contextlib.suppress(Exception):
+        await ctx.bot.send_chat_action(chat_id, ChatAction.TYPING)
+
+STREAM_EDIT_SEC  = float(os.getenv("STREAM_EDIT_SEC", "1.5"))   # не чаще одной правки статуса
+STREAM_MAX_EDITS = int(os.getenv("STREAM_MAX_EDITS", "8"))      # и не больше стольких за решение
+
+class _StatusProgress:
+    # показывает в статус-сообщении, что модель реально пишет: редкие правки в фоне,
+    # стрим не ждёт Telegram, новая правка не ставится, пока не ушла предыдущая
+    def __init__(self, ctx: ContextTypes.DEFAULT_TYPE, msg):
+        self.ctx = ctx
+        self.msg = msg
+        self.edits = 0
+        self._last = 0.0
+        self._task: Optional[asyncio.Task] = None
 
-# Временное хранилище последнего решения для кнопки «Развернуть»
-SOLUTIONS: dict[int, str] = {}
+    def __call__(self, text: str):
+        t = time.monotonic()
+        if self.edits >= STREAM_MAX_EDITS or t - self._last < STREAM_EDIT_SEC:
+            return
+        if self._task and not self._task.done():
+            return
+        self._last = t; self.edits += 1
+        lines = [ln for ln in text.splitlines() if ln.strip()]
+        tail = lines[-1].strip() if lines else ""
+        if len(tail) > 80:
+            tail = tail[:79] + "…"
+        self._task = asyncio.get_running_loop().create_task(
+            self._edit(f"📐 Составляю решение… ({len(text)} симв.)\n\n{tail}"))
+
+    async def _edit(self, text: str):
+        with contextlib.suppress(Exception):
+            await self.msg.edit_text(text)
+        with contextlib.suppress(Exception):
+            await self.ctx.bot.send_chat_action(self.msg.chat_id, ChatAction.TYPING)
+
+    async def close(self):
+        if self._task:
+            with contextlib.suppress(Exception):
+                await self._task
 
 async def _think_and_prepare(
-    ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, coro: Callable[[], Awaitable[str]]
+    ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, coro: Callable[[ProgressFn], Awaitable[str]],
+    ticket: "Optional[SolveTicket]" = None,
 ) -> None:
+    # ticket только ждём; освобождает его вызывающий в своём finally
     msg = await ctx.bot.send_message(chat_id, "🤔 Думаю над задачей…")
     try:
-        await _send_typing(ctx, chat_id); await msg.edit_text("🧠 Анализирую условие…")
-        await _send_typing(ctx, chat_id); await msg.edit_text("📐 Составляю решение…")
-        text = await coro()
-        SOLUTIONS[chat_id] = text
+        if ticket is not None:
+            if await ticket.wait(lambda pos: msg.edit_text(f"⏳ Ты в очереди: {pos}-й. Скоро начну 🙂")):
+                with contextlib.suppress(Exception):
+                    await msg.edit_text("🤔 Думаю над задачей…")
+        await _send_typing(ctx, chat_id)
+        progress = _StatusProgress(ctx, msg)
+        try:
+            text = await coro(progress)
+        finally:
+            await progress.close()   # последняя правка прогресса не должна перетереть «Ответ готов»
+        await SOLUTIONS.put(chat_id, msg.message_id, text)
         kb = InlineKeyboardMarkup([[InlineKeyboardButton("▸ Развернуть решение", callback_data="sol:show")]])
         await msg.edit_text("✅ Ответ готов!\n\nНажми «▸ Развернуть решение»", reply_markup=kb)
     except Exception as e:
@@ -141,54 +479,247 @@ async def _think_and_prepare(
 def today_key() -> str: return time.strftime("%Y%m%d", time.gmtime())
 def now() -> int: return int(time.time())
 
+class Database:
+    # одно долгоживущее соединение-писатель + несколько читателей (WAL даёт читать параллельно с записью);
+    # запись сериализуется локом, чтения раздаются из очереди свободных соединений
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",      # ~16 МБ страничного кэша на соединение
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.n_readers = readers
+        self.writer: Optional[aiosqlite.Connection] = None
+        self._readers: list[aiosqlite.Connection] = []
+        self._free: Optional[asyncio.Queue] = None
+        self._wlock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        self.writer = await self._connect()
+        self._free = asyncio.Queue()
+        for _ in range(self.n_readers):
+            conn = await self._connect()
+            await conn.execute("PRAGMA query_only=1")
+            self._readers.append(conn)
+            self._free.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._readers:
+            await conn.close()
+        self._readers.clear()
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        with METRICS.timer("db", op="read"):
+            conn = await self._free.get()
+            try:
+                async with conn.execute(sql, params) as cur:
+                    return await cur.fetchone()
+            finally:
+                self._free.put_nowait(conn)
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        with METRICS.timer("db", op="read"):
+            conn = await self._free.get()
+            try:
+                async with conn.execute(sql, params) as cur:
+                    return await cur.fetchall()
+            finally:
+                self._free.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        with METRICS.timer("db", op="write"):
+            async with self._wlock:
+                try:
+                    yield self.writer
+                    await self.writer.commit()
+                except BaseException:
+                    await self.writer.rollback()
+                    raise
+
+    async def execute(self, sql: str, params: tuple = ()):
+        async with self.transaction() as db:
+            await db.execute(sql, params)
+
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB = Database(DB_PATH, DB_READERS)
+
+# Миграции схемы: номер применённой хранится в PRAGMA user_version, на старте выполняются
+# только новые. Каждая идемпотентна (IF NOT EXISTS), поэтому прерванную можно повторить.
+async def _migrate_base(db):
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        user_id INTEGER PRIMARY KEY,
+        premium_until INTEGER DEFAULT 0,
+        referrer_id INTEGER
+    )""")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS usage(
+        day TEXT,
+        user_id INTEGER,
+        texts INTEGER DEFAULT 0,
+        photos INTEGER DEFAULT 0,
+        PRIMARY KEY(day, user_id)
+    )""")
+    # старые базы без колонки photos
+    async with db.execute("PRAGMA table_info(usage)") as cur:
+        cols = {row[1] for row in await cur.fetchall()}
+    if "photos" not in cols:
+        await db.execute("ALTER TABLE usage ADD COLUMN photos INTEGER DEFAULT 0")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS payments(
+        invoice_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        stars INTEGER,
+        created_at INTEGER
+    )""")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS referrals(
+        referrer_id INTEGER,
+        invited_id INTEGER,
+        UNIQUE(referrer_id, invited_id)
+    )""")
+
+async def _migrate_answer_cache(db):
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS answer_cache(
+        key TEXT PRIMARY KEY,
+        answer TEXT,
+        size INTEGER,
+        created_at INTEGER,
+        hit_at INTEGER
+    )""")
+    await db.execute("CREATE INDEX IF NOT EXISTS answer_cache_hit_at ON answer_cache(hit_at)")
+
+async def _migrate_solutions(db):
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS solutions(
+        chat_id INTEGER,
+        message_id INTEGER,
+        body BLOB,
+        created_at INTEGER,
+        PRIMARY KEY(chat_id, message_id)
+    )""")
+
+async def _migrate_retention(db):
+    # помесячные итоги вместо старых дневных строк usage (см. UsageRetention)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS usage_monthly(
+        month TEXT,
+        user_id INTEGER,
+        texts INTEGER DEFAULT 0,
+        photos INTEGER DEFAULT 0,
+        days INTEGER DEFAULT 0,
+        PRIMARY KEY(user_id, month)
+    )""")
+    # выборки по пользователю: PK usage начинается с day, у referrals — только UNIQUE(referrer_id, …)
+    await db.execute("CREATE INDEX IF NOT EXISTS usage_user_day ON usage(user_id, day)")
+    await db.execute("CREATE INDEX IF NOT EXISTS referrals_invited ON referrals(invited_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS users_referrer ON users(referrer_id)")
+
+async def _migrate_solutions_index(db):
+    # чистка просроченных решений по created_at без полного скана
+    await db.execute("CREATE INDEX IF NOT EXISTS solutions_created_at ON solutions(created_at)")
+
+MIGRATIONS = [_migrate_base, _migrate_answer_cache, _migrate_solutions, _migrate_retention, _migrate_solutions_index]
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            premium_until INTEGER DEFAULT 0,
-            referrer_id INTEGER
-        )""")
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS usage(
-            day TEXT,
-            user_id INTEGER,
-            texts INTEGER DEFAULT 0,
-            photos INTEGER DEFAULT 0,
-            PRIMARY KEY(day, user_id)
-        )""")
-        try:
-            await db.execute("ALTER TABLE usage ADD COLUMN photos INTEGER DEFAULT 0")
-        except Exception:
-            pass
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS payments(
-            invoice_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            stars INTEGER,
-            created_at INTEGER
-        )""")
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS referrals(
-            referrer_id INTEGER,
-            invited_id INTEGER,
-            UNIQUE(referrer_id, invited_id)
-        )""")
-        await db.commit()
+    await DB.open()
+    row = await DB.fetchone("PRAGMA user_version")
+    for version in range(row[0] + 1, len(MIGRATIONS) + 1):
+        async with DB.transaction() as db:
+            await MIGRATIONS[version - 1](db)
+            await db.execute(f"PRAGMA user_version={version}")
+        print(f"[DB] migrated to v{version}")
+    row = await DB.fetchone("PRAGMA auto_vacuum")
+    if row[0] != 2:
+        # INCREMENTAL включается только полным VACUUM — один раз, вне транзакции.
+        # Дальше место от удалённых строк возвращает UsageRetention через incremental_vacuum
+        t = time.perf_counter()
+        async with DB.transaction() as db:
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+        print(f"[DB] auto_vacuum=INCREMENTAL ({time.perf_counter() - t:.1f}s)")
+
+async def close_db():
+    await DB.close()
+
+class UserCache:
+    # LRU+TTL кэш строк users: (premium_until, referrer_id). Истечение премиума считается
+    # по закэшированному premium_until, поэтому TTL нужен только на случай правок БД извне.
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._rows: "OrderedDict[int, tuple[float, tuple]]" = OrderedDict()
+        self._gen = 0          # растёт на каждую запись: чтение, начатое до неё, не кладёт устаревшее
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        item = self._rows.get(user_id)
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            self.misses += 1
+            return None
+        self._rows.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def generation(self) -> int:
+        return self._gen
+
+    def put(self, user_id: int, row: tuple, gen: int | None = None):
+        if gen is not None and gen != self._gen:
+            return
+        self._rows[user_id] = (time.monotonic(), row)
+        self._rows.move_to_end(user_id)
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+
+    def update(self, user_id: int, row: tuple):
+        self._gen += 1
+        self.put(user_id, row)
+
+    def invalidate(self, user_id: int):
+        self._gen += 1
+        self._rows.pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._rows), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0}
+
+USER_CACHE = UserCache(int(os.getenv("USER_CACHE_SIZE", "50000")), float(os.getenv("USER_CACHE_TTL", "300")))
 
 async def ensure_user(user_id: int, referrer_id: int | None = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO users(user_id, premium_until, referrer_id) VALUES(?,0,?)",
-            (user_id, referrer_id),
-        )
-        await db.commit()
+    await DB.execute(
+        "INSERT OR IGNORE INTO users(user_id, premium_until, referrer_id) VALUES(?,0,?)",
+        (user_id, referrer_id),
+    )
+    USER_CACHE.invalidate(user_id)
 
 async def get_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT premium_until, referrer_id FROM users WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return row if row else (0, None)
+    row = USER_CACHE.get(user_id)
+    if row is not None:
+        return row
+    gen = USER_CACHE.generation()
+    row = await DB.fetchone("SELECT premium_until, referrer_id FROM users WHERE user_id=?", (user_id,))
+    row = tuple(row) if row else (0, None)
+    USER_CACHE.put(user_id, row, gen)
+    return row
 
 async def set_referrer(invited_id: int, ref_id: int):
     if invited_id == ref_id:
@@ -196,19 +727,70 @@ async def set_referrer(invited_id: int, ref_id: int):
     pu, ref_exists = await get_user(invited_id)
     if ref_exists is not None:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET referrer_id=? WHERE user_id=? AND referrer_id IS NULL", (ref_id, invited_id))
-        await db.execute("INSERT OR IGNORE INTO referrals(referrer_id, invited_id) VALUES(?,?)", (ref_id, invited_id))
-        await db.commit()
+    try:
+        async with DB.transaction() as db:
+            await db.execute("UPDATE users SET referrer_id=? WHERE user_id=? AND referrer_id IS NULL", (ref_id, invited_id))
+            await db.execute("INSERT OR IGNORE INTO referrals(referrer_id, invited_id) VALUES(?,?)", (ref_id, invited_id))
+    finally:
+        USER_CACHE.invalidate(invited_id)
+
+async def _extend_premium(db, user_id: int, seconds: int, ts: int) -> tuple[int, Optional[int]]:
+    # продление одним UPSERT: max() считается в SQLite, параллельные оплаты не теряют дни
+    async with db.execute(
+        "INSERT INTO users(user_id, premium_until) VALUES(?,?) ON CONFLICT(user_id) DO UPDATE "
+        "SET premium_until=max(coalesce(premium_until, 0), ?) + ? RETURNING premium_until, referrer_id",
+        (user_id, ts + seconds, ts, seconds),
+    ) as cur:
+        return tuple(await cur.fetchone())
+
+async def _user_row(db, user_id: int) -> tuple[int, Optional[int]]:
+    async with db.execute("SELECT premium_until, referrer_id FROM users WHERE user_id=?", (user_id,)) as cur:
+        row = await cur.fetchone()
+    return tuple(row) if row else (0, None)
 
 async def add_premium_days(user_id: int, days: int):
-    pu, _ = await get_user(user_id)
-    base = max(pu, now())
-    new_until = base + days*86400
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET premium_until=? WHERE user_id=?", (new_until, user_id))
-        await db.commit()
-    return new_until
+    try:
+        async with DB.transaction() as db:
+            row = await _extend_premium(db, user_id, days * 86400, now())
+    except BaseException:
+        USER_CACHE.invalidate(user_id)
+        raise
+    USER_CACHE.update(user_id, row)
+    _invalidate_on_owner(user_id)
+    return row[0]
+
+async def process_payment(charge_id: str, user_id: int, stars: int, days: int,
+                          ref_days: int = REF_BONUS_DAYS) -> tuple[bool, int, Optional[int], Optional[int]]:
+    # платёж, продление покупателю и бонус рефереру — одна транзакция.
+    # Идемпотентно по telegram_payment_charge_id: повторная доставка апдейта ничего не начисляет.
+    # -> (новый ли платёж, premium_until покупателя, referrer_id, premium_until реферера)
+    ts = now()
+    rows: dict[int, tuple] = {}
+    try:
+        async with DB.transaction() as db:
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO payments(invoice_id,user_id,stars,created_at) VALUES(?,?,?,?)",
+                (charge_id, user_id, stars, ts),
+            )
+            fresh = cur.rowcount == 1
+            if fresh:
+                rows[user_id] = await _extend_premium(db, user_id, days * 86400, ts)
+            else:
+                rows[user_id] = await _user_row(db, user_id)
+            ref = rows[user_id][1]
+            if ref:
+                if fresh and ref_days:
+                    rows[ref] = await _extend_premium(db, ref, ref_days * 86400, ts)
+                else:
+                    rows[ref] = await _user_row(db, ref)
+    except BaseException:
+        USER_CACHE.invalidate(user_id)
+        raise
+    for uid, row in rows.items():
+        USER_CACHE.update(uid, row)
+        if fresh:
+            _invalidate_on_owner(uid)
+    return fresh, rows[user_id][0], ref, rows[ref][0] if ref else None
 
 async def is_premium(user_id: int) -> bool:
     pu, _ = await get_user(user_id)
@@ -217,20 +799,292 @@ async def is_premium(user_id: int) -> bool:
 def human_until(ts: int) -> str:
     lt = time.localtime(ts); return time.strftime("%d.%m.%Y %H:%M", lt)
 
+class UsageCounters:
+    # дневные счётчики в памяти: проверка лимита без БД, в usage уходят только дельты пачкой.
+    # Между проверкой и инкрементом нет await, поэтому параллельные апдейты одного юзера не гонятся.
+    def __init__(self, db: Database):
+        self.db = db
+        self._counts: dict[tuple[str, int], list[int]] = {}   # (day, user_id) -> [texts, photos]
+        self._deltas: dict[tuple[str, int], list[int]] = {}
+        self._loading: dict[tuple[str, int], asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stop: Optional[asyncio.Event] = None
+
+    async def _load(self, key: tuple[str, int]) -> list[int]:
+        c = self._counts.get(key)
+        if c is not None:
+            return c
+        fut = self._loading.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[key] = fut
+        try:
+            row = await self.db.fetchone("SELECT texts, photos FROM usage WHERE day=? AND user_id=?", key)
+            c = self._counts.setdefault(key, [row[0], row[1]] if row else [0, 0])
+            fut.set_result(c)
+            return c
+        except BaseException as e:
+            fut.set_exception(e); fut.exception()   # не оставлять «never retrieved»
+            raise
+        finally:
+            del self._loading[key]
+
+    async def get(self, day: str, user_id: int) -> tuple[int, int]:
+        c = await self._load((day, user_id))
+        return c[0], c[1]
+
+    def _bump(self, key: tuple[str, int], c: list[int], idx: int):
+        c[idx] += 1
+        self._deltas.setdefault(key, [0, 0])[idx] += 1
+
+    async def add(self, day: str, user_id: int, kind: str):
+        key = (day, user_id)
+        self._bump(key, await self._load(key), 0 if kind == "text" else 1)
+
+    async def try_consume(self, day: str, user_id: int, kind: str, limit: int) -> bool:
+        key = (day, user_id); idx = 0 if kind == "text" else 1
+        c = await self._load(key)
+        if c[idx] >= limit:
+            return False
+        self._bump(key, c, idx)
+        return True
+
+    async def flush(self):
+        if self._deltas:
+            batch, self._deltas = self._deltas, {}
+            try:
+                async with self.db.transaction() as db:
+                    await db.executemany(
+                        "INSERT INTO usage(day,user_id,texts,photos) VALUES(?,?,?,?) "
+                        "ON CONFLICT(day,user_id) DO UPDATE SET "
+                        "texts=texts+excluded.texts, photos=photos+excluded.photos",
+                        [(d, uid, t, p) for (d, uid), (t, p) in batch.items()],
+                    )
+            except Exception:
+                # вернуть дельты, чтобы не потерять их до следующей попытки
+                for key, (t, p) in batch.items():
+                    d = self._deltas.setdefault(key, [0, 0]); d[0] += t; d[1] += p
+                raise
+        # вчерашние счётчики больше не нужны
+        day = today_key()
+        for key in [k for k in self._counts if k[0] != day and k not in self._deltas]:
+            del self._counts[key]
+
+    async def _run(self, interval: float):
+        while not self._stop.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stop.wait(), interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[USAGE] flush failed: {type(e).__name__}: {e}")
+
+    def start(self, interval: float):
+        self._stop = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        # не cancel: отмена посреди flush потеряла бы уже вынутую пачку дельт.
+        # Цикл доделывает текущий сброс и выходит сам
+        if self._task:
+            self._stop.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+USAGE_FLUSH_SEC = float(os.getenv("USAGE_FLUSH_SEC", "5"))
+USAGE = UsageCounters(DB)
+
+class UsageRetention:
+    # жизненный цикл usage: дневные строки старше retention_days сворачиваются в usage_monthly
+    # и удаляются. Пачками по batch строк, каждая — своя короткая транзакция, между ними
+    # лок писателя отпускается, поэтому сброс счётчиков и оплаты не ждут всю чистку
+    def __init__(self, db: Database, retention_days: int, batch: int, vacuum_pages: int):
+        self.db = db
+        self.retention_days = retention_days
+        self.batch = batch
+        self.vacuum_pages = vacuum_pages
+        self.rolled_up = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _rollup_batch(self, cutoff: str) -> int:
+        # обе выборки — одна и та же первая пачка по PK (day, user_id) внутри одной транзакции
+        pick = "SELECT rowid, day, user_id, texts, photos FROM usage WHERE day<? ORDER BY day, user_id LIMIT ?"
+        async with self.db.transaction() as db:
+            await db.execute(
+                f"INSERT INTO usage_monthly(month, user_id, texts, photos, days) "
+                f"SELECT substr(day, 1, 6), user_id, sum(texts), sum(photos), count(*) FROM ({pick}) "
+                f"GROUP BY 1, 2 "
+                f"ON CONFLICT(user_id, month) DO UPDATE SET texts=texts+excluded.texts, "
+                f"photos=photos+excluded.photos, days=days+excluded.days",
+                (cutoff, self.batch),
+            )
+            cur = await db.execute(f"DELETE FROM usage WHERE rowid IN (SELECT rowid FROM ({pick}))", (cutoff, self.batch))
+            return cur.rowcount
+
+    async def _vacuum(self) -> int:
+        row = await self.db.fetchone("PRAGMA freelist_count")
+        if not row[0]:
+            return 0
+        async with self.db.transaction() as db:
+            # execute() делает один шаг и освобождает одну страницу; executescript доводит до конца
+            await db.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+        return min(row[0], self.vacuum_pages)
+
+    async def run_once(self) -> tuple[int, int]:
+        cutoff = time.strftime("%Y%m%d", time.gmtime(time.time() - self.retention_days * 86400))
+        moved = 0
+        while True:
+            n = await self._rollup_batch(cutoff)
+            moved += n
+            if n < self.batch:
+                break
+            await asyncio.sleep(0.05)
+        self.rolled_up += moved
+        return moved, await self._vacuum()
+
+    async def _run(self, interval: float):
+        while True:
+            try:
+                moved, pages = await self.run_once()
+                if moved or pages:
+                    print(f"[USAGE] rolled up {moved} rows, vacuumed {pages} pages")
+            except Exception as e:
+                print(f"[USAGE] retention failed: {type(e).__name__}: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float):
+        self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+USAGE_RETENTION_SEC = float(os.getenv("USAGE_RETENTION_SEC", "3600"))
+RETENTION = UsageRetention(
+    DB,
+    retention_days=int(os.getenv("USAGE_RETENTION_DAYS", "90")),
+    batch=int(os.getenv("USAGE_PRUNE_BATCH", "500")),
+    vacuum_pages=int(os.getenv("VACUUM_PAGES", "2000")),
+)
+
 async def get_usage(day: str, user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT texts, photos FROM usage WHERE day=? AND user_id=?", (day, user_id)) as cur:
-            row = await cur.fetchone()
-            return (row[0], row[1]) if row else (0, 0)
+    return await USAGE.get(day, user_id)
 
 async def inc_usage(day: str, user_id: int, kind: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO usage(day,user_id,texts,photos) VALUES(?,?,0,0)", (day, user_id))
-        if kind == "text":
-            await db.execute("UPDATE usage SET texts=texts+1 WHERE day=? AND user_id=?", (day, user_id))
-        else:
-            await db.execute("UPDATE usage SET photos=photos+1 WHERE day=? AND user_id=?", (day, user_id))
-        await db.commit()
+    await USAGE.add(day, user_id, kind)
+
+# ---------- Solutions ----------
+class SolutionStore:
+    # решения для кнопки «Развернуть» по (chat_id, message_id) статус-сообщения.
+    # В памяти — LRU с лимитом по байтам и TTL; вытесненное (и всё при остановке)
+    # при spill=True сжимается в таблицу solutions. write_through=True пишет в таблицу
+    # сразу: решение переживает падение воркера и смену WEB_WORKERS (чат уезжает в другой процесс)
+    def __init__(self, db: Database, max_bytes: int, ttl: int, spill: bool, write_through: bool = False):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill = spill or write_through
+        self.write_through = write_through
+        self._mem: "OrderedDict[tuple[int, int], tuple[int, str]]" = OrderedDict()
+        self._bytes = 0
+        self._pruned_at = 0
+        self._prune_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _size(text: str) -> int:
+        return len(text) * 2 + 100   # грубо: строка + ключ и кортеж
+
+    def _pop_lru(self) -> tuple[tuple[int, int], tuple[int, str]]:
+        key, item = self._mem.popitem(last=False)
+        self._bytes -= self._size(item[1])
+        return key, item
+
+    async def _write(self, items: list, prune: bool = True):
+        if not (self.spill and items):
+            return
+        async with self.db.transaction() as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO solutions(chat_id, message_id, body, created_at) VALUES(?,?,?,?)",
+                [(c, m, zlib.compress(text.encode(), 6), ts) for (c, m), (ts, text) in items],
+            )
+        if prune and now() - self._pruned_at >= 60 and self._prune_task is None:
+            self._pruned_at = now()
+            self._prune_task = _background(self.prune())
+
+    async def prune(self, batch: int = 500):
+        # просроченное — пачками в отдельных транзакциях, чтобы не держать лок писателя
+        try:
+            while True:
+                async with self.db.transaction() as db:
+                    cur = await db.execute(
+                        "DELETE FROM solutions WHERE rowid IN "
+                        "(SELECT rowid FROM solutions WHERE created_at<? LIMIT ?)",
+                        (now() - self.ttl, batch),
+                    )
+                if cur.rowcount < batch:
+                    break
+                await asyncio.sleep(0.05)
+        except Exception as e:
+            print(f"[SOLUTIONS] prune failed: {type(e).__name__}: {e}")
+        finally:
+            self._prune_task = None
+
+    async def put(self, chat_id: int, message_id: int, text: str):
+        key = (chat_id, message_id)
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._bytes -= self._size(old[1])
+        item = self._mem[key] = (now(), text)
+        self._bytes += self._size(text)
+        evicted = []
+        cutoff = now() - self.ttl
+        while self._mem and (self._bytes > self.max_bytes or next(iter(self._mem.values()))[0] < cutoff):
+            k, old = self._pop_lru()
+            if old[0] >= cutoff:
+                evicted.append((k, old))
+        # при write_through вытесненное уже лежит в таблице
+        await self._write([(key, item)] if self.write_through else evicted)
+
+    async def get(self, chat_id: int, message_id: int) -> Optional[str]:
+        key = (chat_id, message_id)
+        item = self._mem.get(key)
+        if item is not None:
+            if item[0] >= now() - self.ttl:
+                self._mem.move_to_end(key)
+                return item[1]
+            self._mem.pop(key); self._bytes -= self._size(item[1])
+            return None
+        if not self.spill:
+            return None
+        row = await self.db.fetchone(
+            "SELECT body FROM solutions WHERE chat_id=? AND message_id=? AND created_at>=?",
+            (chat_id, message_id, now() - self.ttl),
+        )
+        return zlib.decompress(row[0]).decode() if row else None
+
+    async def flush(self):
+        # вызывается перед close_db: фоновую чистку останавливаем (её транзакция откатится),
+        # новую не запускаем
+        task = self._prune_task
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        if not self.write_through:
+            await self._write(list(self._mem.items()), prune=False)
+
+SOLUTIONS = SolutionStore(
+    DB,
+    max_bytes=int(float(os.getenv("SOLUTIONS_MEM_MB", "32")) * 1024 * 1024),
+    ttl=int(float(os.getenv("SOLUTIONS_TTL_HOURS", "72")) * 3600),
+    spill=os.getenv("SOLUTIONS_SPILL", "1") != "0",
+    write_through=os.getenv("SOLUTIONS_WRITE_THROUGH", "1" if WEB_WORKERS > 1 else "0") != "0",
+)
 
 # ---------- Keyboards ----------
 def premium_keyboard():
@@ -263,55 +1117,237 @@ STYLE = (
     " Используй знаки × и ÷ вместо \\times и / в тексте. В конце отдельной строкой: «Ответ: …»."
 )
 
-async def solve_text_with_openai(prompt: str) -> str:
-    if not oai_client:
+# версия промпта входит в ключ кэша: поменяли STYLE — старые ответы не используются
+STYLE_VERSION = hashlib.sha1(STYLE.encode()).hexdigest()[:8]
+TEXT_MODEL = "gpt-4o-mini"
+
+_OPS_CANON = str.maketrans({"×": "*", "·": "*", "∙": "*", "÷": "/", "−": "-", "–": "-"})
+_WS = re.compile(r"\s+")
+# индексы значимы: «5²» — это 5^2, а не 52, поэтому никакого NFKC, только явная замена
+_SUP = str.maketrans("⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿ", "0123456789+-=()n")
+_SUB = str.maketrans("₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎", "0123456789+-=()")
+_SUP_RUN = re.compile(r"[⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿ]+")
+_SUB_RUN = re.compile(r"[₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎]+")
+PROMPT_NORM_VERSION = "2"      # входит в ключ кэша: смена нормализации не отдаёт старые ответы
+def normalize_prompt(text: str) -> str:
+    t = _SUP_RUN.sub(lambda m: "^" + m.group().translate(_SUP), text or "")
+    t = _SUB_RUN.sub(lambda m: "_" + m.group().translate(_SUB), t)
+    t = unicodedata.normalize("NFC", t).lower().translate(_OPS_CANON)
+    t = _WS.sub(" ", t).strip()
+    return re.sub(r" ?([*/+=()-]) ?", r"\1", t)   # «2 × 3» и «2*3» — одно и то же
+
+class AnswerCache:
+    # ответы модели по хэшу нормализованного запроса: LRU в памяти + таблица answer_cache
+    # (TTL и лимит размера). single_flight склеивает одинаковые одновременные запросы в один вызов.
+    def __init__(self, db: Database, mem_items: int, max_bytes: int, ttl: int, single_flight: bool = True):
+        self.db = db
+        self.mem_items = mem_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.single_flight = single_flight
+        self._mem: "OrderedDict[str, tuple[int, str]]" = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._disk_bytes: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha256("\x00".join(parts).encode()).hexdigest()
+
+    def _remember(self, key: str, created_at: int, answer: str):
+        self._mem[key] = (created_at, answer)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_items:
+            self._mem.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        cutoff = now() - self.ttl
+        item = self._mem.get(key)
+        if item is not None:
+            if item[0] >= cutoff:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._mem[key]
+        row = await self.db.fetchone(
+            "SELECT answer, created_at FROM answer_cache WHERE key=? AND created_at>=?", (key, cutoff))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, row[1], row[0])
+        await self.db.execute("UPDATE answer_cache SET hit_at=? WHERE key=?", (now(), key))
+        return row[0]
+
+    async def put(self, key: str, answer: str):
+        ts = now(); size = len(answer.encode())
+        self._remember(key, ts, answer)
+        async with self.db.transaction() as db:
+            async with db.execute("SELECT size FROM answer_cache WHERE key=?", (key,)) as cur:
+                old = await cur.fetchone()
+            await db.execute(
+                "INSERT OR REPLACE INTO answer_cache(key, answer, size, created_at, hit_at) VALUES(?,?,?,?,?)",
+                (key, answer, size, ts, ts))
+        if self._disk_bytes is not None:
+            self._disk_bytes += size - (old[0] if old else 0)
+        await self._evict()
+
+    async def _evict(self):
+        if self._disk_bytes is None:
+            row = await self.db.fetchone("SELECT COALESCE(SUM(size),0) FROM answer_cache")
+            self._disk_bytes = row[0]
+        if self._disk_bytes <= self.max_bytes:
+            return
+        async with self.db.transaction() as db:
+            await db.execute("DELETE FROM answer_cache WHERE created_at<?", (now() - self.ttl,))
+            # оставляем самые свежие по hit_at в пределах 90% лимита, чтобы не чистить на каждом put
+            await db.execute("""
+            DELETE FROM answer_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY hit_at DESC, key) AS acc FROM answer_cache
+                ) WHERE acc > ?
+            )""", (int(self.max_bytes * 0.9),))
+            async with db.execute("SELECT COALESCE(SUM(size),0) FROM answer_cache") as cur:
+                self._disk_bytes = (await cur.fetchone())[0]
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[tuple[str, Optional[str]]]]) -> str:
+        # compute -> (ответ, finish_reason). Кэш общий на всех пользователей, поэтому кладём
+        # только законченные ответы: обрезанный по max_tokens ("length") отдаём, но не храним
+        cached = await self.get(key)
+        if cached is not None:
+            return cached
+        if not self.single_flight:
+            answer, finish = await compute()
+            if finish == "stop":
+                await self.put(key, answer)
+            return answer
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            answer, finish = await compute()
+            fut.set_result(answer)
+        except BaseException as e:
+            fut.set_exception(e); fut.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        if finish == "stop":
+            await self.put(key, answer)
+        return answer
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"mem_size": len(self._mem), "disk_bytes": self._disk_bytes or 0, "hits": self.hits,
+                "misses": self.misses, "hit_ratio": self.hits / total if total else 0.0}
+
+ANSWER_CACHE = AnswerCache(
+    DB,
+    mem_items=int(os.getenv("ANSWER_CACHE_ITEMS", "2048")),
+    max_bytes=int(float(os.getenv("ANSWER_CACHE_MB", "64")) * 1024 * 1024),
+    ttl=int(float(os.getenv("ANSWER_CACHE_TTL_DAYS", "30")) * 86400),
+    single_flight=os.getenv("ANSWER_SINGLE_FLIGHT", "1") != "0",
+)
+
+async def _ask_text(prompt: str, on_progress: Optional[ProgressFn] = None) -> tuple[str, Optional[str]]:
+    return await _chat_completion(
+        on_progress,
+        model=TEXT_MODEL,
+        messages=[{"role":"system","content":STYLE},{"role":"user","content":prompt}],
+        temperature=0.2, max_tokens=1200,
+    )
+
+async def solve_text_with_openai(prompt: str, on_progress: Optional[ProgressFn] = None) -> str:
+    if not (OPENAI_API_KEY or oai_client):
         return "OpenAI ключ не задан."
     try:
-        resp = oai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role":"system","content":STYLE},{"role":"user","content":prompt}],
-            temperature=0.2, max_tokens=1200,
-        )
-        return resp.choices[0].message.content.strip()
-    except RateLimitError:
-        return "Пока не могу ответить — исчерпан лимит OpenAI (429). Попробуй позже 🙏"
+        # ошибки не кэшируются: исключение пролетает мимо put
+        key = AnswerCache.key("text", STYLE_VERSION, TEXT_MODEL, PROMPT_NORM_VERSION, normalize_prompt(prompt))
+        return await ANSWER_CACHE.get_or_compute(key, lambda: _ask_text(prompt, on_progress))
+    except EmptyAnswer:
+        return "Модель вернула пустой ответ 😕 Пришли задачу ещё раз."
     except Exception as e:
+        if _is_rate_limit(e):
+            return "Пока не могу ответить — исчерпан лимит OpenAI (429). Попробуй позже 🙏"
         return f"Упс, ошибка: {type(e).__name__}"
 
-async def solve_image_with_openai(file_url: str, question: str) -> str:
-    if not oai_client:
+async def _ask_image(image_url: str, question: str, on_progress: Optional[ProgressFn] = None) -> tuple[str, Optional[str]]:
+    prompt = (question or "") + "\n"
+    prompt += ("Реши задачу по фото подробно: «Дано», шаги 1–3 (произведение/подстановка/упрощение). "
+               "НЕ используй \\( \\) \\[ \\] и $$; разрешены \\frac, \\sqrt, степени. "
+               "В тексте ставь × и ÷. В конце строка «Ответ: …».")
+    return await _chat_completion(
+        on_progress,
+        model=TEXT_MODEL,
+        messages=[{
+            "role":"user",
+            "content":[
+                {"type":"text","text":prompt},
+                {"type":"image_url","image_url":{"url":image_url}},
+            ],
+        }],
+        temperature=0.2, max_tokens=1200,
+    )
+
+async def solve_image_with_openai(
+    file_url: str, question: str, image_hash: str | None = None, on_progress: Optional[ProgressFn] = None
+) -> str:
+    if not (OPENAI_API_KEY or oai_client):
         return "OpenAI ключ не задан."
     try:
-        prompt = (question or "") + "\n"
-        prompt += ("Реши задачу по фото подробно: «Дано», шаги 1–3 (произведение/подстановка/упрощение). "
-                   "НЕ используй \\( \\) \\[ \\] и $$; разрешены \\frac, \\sqrt, степени. "
-                   "В тексте ставь × и ÷. В конце строка «Ответ: …».")
-        resp = oai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role":"user",
-                "content":[
-                    {"type":"text","text":prompt},
-                    {"type":"image_url","image_url":{"url":file_url}},
-                ],
-            }],
-            temperature=0.2, max_tokens=1200,
-        )
-        return resp.choices[0].message.content.strip()
-    except RateLimitError:
-        return "Пока не могу — лимит OpenAI (429). Попробуй позже 🙏"
+        if image_hash is None:
+            return (await _ask_image(file_url, question, on_progress))[0]
+        # кэш только для того же самого изображения (повторная отправка), а не «похожего»
+        key = AnswerCache.key("image-px", STYLE_VERSION, TEXT_MODEL, PROMPT_NORM_VERSION, image_hash, normalize_prompt(question))
+        return await ANSWER_CACHE.get_or_compute(key, lambda: _ask_image(file_url, question, on_progress))
+    except EmptyAnswer:
+        return "Модель вернула пустой ответ 😕 Пришли задачу ещё раз."
     except Exception as e:
+        if _is_rate_limit(e):
+            return "Пока не могу — лимит OpenAI (429). Попробуй позже 🙏"
         return f"Упс, ошибка: {type(e).__name__}"
 
-# ---- определить что это «математика» (рендерить PNG), а не сочинение
-MATH_RE = re.compile(r'(?=.*\d)(?=.*[+\-*/×÷=^])', re.S)
-def _is_math(text: str) -> bool:
-    t = text or ""
-    letters = sum(ch.isalpha() for ch in t)
-    ops     = sum(ch in "+-*/×÷=^" for ch in t)
-    if letters > 600 and ops < 5:  # длинное эссе — текстом
-        return False
-    return bool(MATH_RE.search(t)) or any(k in t for k in ["\\frac","\\sqrt","^{","_{"])
+# ---------- Photo pipeline ----------
+import base64
+
+# vision-модель (detail=high) всё равно вписывает фото в 2048×2048 и ужимает короткую сторону до 768:
+# больше пикселей — только лишние байты и время загрузки
+PHOTO_SHORT_SIDE = int(os.getenv("PHOTO_SHORT_SIDE", "768"))
+PHOTO_LONG_SIDE  = int(os.getenv("PHOTO_LONG_SIDE", "2048"))
+PHOTO_JPEG_Q     = int(os.getenv("PHOTO_JPEG_QUALITY", "85"))
+
+def _pixel_hash(img) -> str:
+    # sha256 пикселей уменьшенной серой копии: совпадает только для того же изображения
+    # (пересланное или повторно отправленное фото). Перцептивные 64-битные хэши склеивали
+    # разные страницы тетради, а кэш ответов общий на всех пользователей
+    g = img.convert("L")
+    return hashlib.sha256(f"{g.width}x{g.height}:".encode() + g.tobytes()).hexdigest()
+
+def prepare_photo(data: bytes) -> tuple[bytes, str]:
+    from PIL import Image, ImageOps   # Pillow грузится при первом фото, не на старте
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    w, h = img.size
+    scale = min(1.0, PHOTO_SHORT_SIDE / min(w, h), PHOTO_LONG_SIDE / max(w, h))
+    if scale < 1.0:
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=PHOTO_JPEG_Q, optimize=True)
+    return buf.getvalue(), _pixel_hash(img)
+
+async def solve_photo(bot, file_id: str, caption: str, on_progress: Optional[ProgressFn] = None) -> str:
+    # скачиваем один раз сами, ужимаем и шлём модели data: URL вместо ссылки на оригинал
+    file = await bot.get_file(file_id)
+    data = bytes(await file.download_as_bytearray())
+    jpeg, image_hash = await asyncio.to_thread(prepare_photo, data)
+    data_url = "data:image/jpeg;base64," + base64.b64encode(jpeg).decode()
+    return await solve_image_with_openai(data_url, caption, image_hash=image_hash, on_progress=on_progress)
+
+# ---- «математика» (рендерить PNG) или сочинение — тот же критерий, что у движка рендера
+_is_math = renderer._is_math
 
 # ---------- UI ----------
 WELCOME_TEXT = (
@@ -379,13 +1415,31 @@ async def menu_router(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cb_show_solution(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     chat_id = q.message.chat.id
-    text = SOLUTIONS.get(chat_id)
+    text = await SOLUTIONS.get(chat_id, q.message.message_id)
     if not text:
         await q.edit_message_text("Нет сохранённого решения. Пришли задачу снова 🙂", reply_markup=back_kb())
         return
+    png = None
     if _is_math(text):          # <— ключевая замена
-        png = render_answer_png(text)
-        await ctx.bot.send_photo(chat_id, png, caption="Готово ✅", reply_markup=back_kb())
+        key = RENDER_CACHE.key(text)
+        fid = RENDER_CACHE.file_id(key)
+        if fid:
+            try:
+                await ctx.bot.send_photo(chat_id, fid, caption="Готово ✅", reply_markup=back_kb())
+                return
+            except BadRequest:
+                RENDER_CACHE.forget_file_id(key)   # file_id протух — рендерим заново
+        try:
+            png = await RENDER_CACHE.png(key, text)
+        except (RenderBusy, asyncio.TimeoutError, BrokenProcessPool):
+            png = None          # рендер перегружен — отдаём текстом
+        except Exception as e:  # ошибка в самом рендере (в т.ч. RENDER_ENGINE=mpl) — тоже текстом
+            print(f"[RENDER] failed: {type(e).__name__}: {e}")
+            png = None
+    if png:
+        sent = await ctx.bot.send_photo(chat_id, png, caption="Готово ✅", reply_markup=back_kb())
+        if sent.photo:
+            RENDER_CACHE.set_file_id(key, sent.photo[-1].file_id)
     else:
         await ctx.bot.send_message(chat_id, _escape_html(text), parse_mode=ParseMode.HTML, reply_markup=back_kb())
 
@@ -411,77 +1465,673 @@ async def successful(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         _, uid_s, days_s, _ts = payload.split(":"); uid, days = int(uid_s), int(days_s)
     except Exception:
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT OR IGNORE INTO payments(invoice_id,user_id,stars,created_at) VALUES(?,?,?,?)",
-            (sp.telegram_payment_charge_id, uid, sp.total_amount, int(time.time()))
-        ); await db.commit()
-    new_until = await add_premium_days(uid, days)
+    fresh, new_until, ref, ref_until = await process_payment(sp.telegram_payment_charge_id, uid, sp.total_amount, days)
+    if not fresh:       # повторная доставка того же платежа
+        await update.message.reply_text(f"Этот платёж уже учтён. Премиум активен до {human_until(new_until)} ✅", reply_markup=back_kb())
+        return
     await update.message.reply_text(f"Оплата успешна! Премиум активен до {human_until(new_until)} ✅", reply_markup=back_kb())
-    _, ref = await get_user(uid)
-    if ref:
-        ref_until = await add_premium_days(ref, REF_BONUS_DAYS)
+    if ref and REF_BONUS_DAYS:
         try:
             await ctx.bot.send_message(ref, f"Твой реферал оформил премиум! +{REF_BONUS_DAYS} дн. 🎁\nПремиум до {human_until(ref_until)}")
         except: pass
 
+# ---------- Solve scheduler ----------
+class SchedulerBusy(Exception):
+    pass
+
+class UserBusy(Exception):
+    pass
+
+class SolveTicket:
+    def __init__(self, sched: "SolveScheduler", user_id: int, cls: str):
+        self.sched = sched
+        self.user_id = user_id
+        self.cls = cls
+        self.started = asyncio.get_running_loop().create_future()
+        self.released = False
+
+    async def wait(self, on_position: Callable[[int], Awaitable] | None = None, every: float = 2.0) -> bool:
+        # ждём свой слот; пока стоим в очереди — сообщаем позицию, если она изменилась.
+        # True — если позицию хоть раз показывали
+        last = None
+        while not self.started.done():
+            pos = self.sched.position(self)
+            if on_position and pos != last and pos > 0:
+                last = pos
+                with contextlib.suppress(Exception):
+                    await on_position(pos)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.shield(self.started), every)
+        return last is not None
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.sched._release(self)
+
+class SolveScheduler:
+    # между хендлерами и моделью: slots задач выполняются одновременно, остальные ждут
+    # в очередях по классам; премиум выбирается чаще (weighted round-robin по weights).
+    # У юзера не больше per_user задач сразу, при очереди длиннее max_queue — сразу отказ.
+    def __init__(self, slots: int, per_user: int, max_queue: int, weights: dict[str, int]):
+        self.slots = slots
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self._queues: dict[str, deque[SolveTicket]] = {cls: deque() for cls in weights}
+        self._order = [cls for cls, w in weights.items() for _ in range(w)]
+        self._turn = 0
+        self._running = 0
+        self._per_user: dict[int, int] = {}
+        self.shed = 0
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def admit(self, user_id: int, premium: bool) -> SolveTicket:
+        if self._per_user.get(user_id, 0) >= self.per_user:
+            raise UserBusy()
+        if self._running >= self.slots and self.queued() >= self.max_queue:
+            self.shed += 1
+            raise SchedulerBusy()
+        t = SolveTicket(self, user_id, "premium" if premium else "free")
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self._queues[t.cls].append(t)
+        self._dispatch()
+        return t
+
+    def position(self, t: SolveTicket) -> int:
+        if t.started.done():
+            return 0
+        q = self._queues[t.cls]
+        try:
+            pos = q.index(t) + 1
+        except ValueError:
+            return 0
+        if t.cls != "premium":          # премиум-очередь обслуживается раньше
+            pos += len(self._queues.get("premium", ()))
+        return pos
+
+    def _dispatch(self):
+        while self._running < self.slots and self.queued():
+            for i in range(len(self._order)):
+                cls = self._order[(self._turn + i) % len(self._order)]
+                if self._queues[cls]:
+                    self._turn = (self._turn + i + 1) % len(self._order)
+                    t = self._queues[cls].popleft()
+                    self._running += 1
+                    t.started.set_result(None)
+                    break
+
+    def _release(self, t: SolveTicket):
+        n = self._per_user.get(t.user_id, 1) - 1
+        if n > 0:
+            self._per_user[t.user_id] = n
+        else:
+            self._per_user.pop(t.user_id, None)
+        if t.started.done():
+            self._running -= 1
+        else:
+            self._queues[t.cls].remove(t)   # ушёл из очереди, так и не начав
+            t.started.cancel()
+        self._dispatch()
+
+SCHEDULER = SolveScheduler(
+    slots=int(os.getenv("SOLVE_SLOTS") or OPENAI_CONCURRENCY),
+    per_user=int(os.getenv("SOLVE_PER_USER", "2")),
+    max_queue=int(os.getenv("SOLVE_MAX_QUEUE", "200")),
+    weights={"premium": int(os.getenv("SOLVE_PREMIUM_WEIGHT", "3")), "free": 1},
+)
+
+async def _admit(update: Update, chat_id: int, premium: bool) -> Optional[SolveTicket]:
+    try:
+        return SCHEDULER.admit(chat_id, premium)
+    except UserBusy:
+        await update.message.reply_text("Я ещё решаю твои прошлые задачи ⏳ Пришли эту чуть позже.")
+    except SchedulerBusy:
+        await update.message.reply_text("Сейчас очень много задач 😅 Попробуй через минуту.", reply_markup=main_menu_kb())
+    return None
+
 # ---------- Business logic ----------
 async def handle_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_text = update.message.text or ""
-    if await is_premium(chat_id):
-        await _think_and_prepare(ctx, chat_id, lambda: solve_text_with_openai(user_text)); return
-    day = today_key(); used_t, _ = await get_usage(day, chat_id)
-    if used_t >= FREE_TEXTS_PER_DAY:
-        await update.message.reply_text("Сегодня лимит по тексту исчерпан. Открой меню → 💎 Подписка.", reply_markup=main_menu_kb()); return
-    await inc_usage(day, chat_id, "text")
-    await _think_and_prepare(ctx, chat_id, lambda: solve_text_with_openai(user_text))
+    premium = await is_premium(chat_id)
+    ticket = await _admit(update, chat_id, premium)
+    if ticket is None:
+        return
+    try:   # слот возвращается при любом исходе, в т.ч. если упал send_message или try_consume
+        if not premium and not await USAGE.try_consume(today_key(), chat_id, "text", FREE_TEXTS_PER_DAY):
+            await update.message.reply_text("Сегодня лимит по тексту исчерпан. Открой меню → 💎 Подписка.", reply_markup=main_menu_kb()); return
+        await _think_and_prepare(ctx, chat_id, lambda progress: solve_text_with_openai(user_text, progress), ticket)
+    finally:
+        ticket.release()
 
 async def handle_photo(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     caption = update.message.caption or ""
-    photo = update.message.photo[-1]
-    file = await ctx.bot.get_file(photo.file_id)
-    file_url = file.file_path
+    photo = update.message.photo[-1]   # самый большой PhotoSize
+
+    premium = await is_premium(chat_id)
+    ticket = await _admit(update, chat_id, premium)
+    if ticket is None:
+        return
+    try:
+        if not premium and not await USAGE.try_consume(today_key(), chat_id, "photo", FREE_PHOTOS_PER_DAY):
+            await update.message.reply_text("Сегодня лимит по фото исчерпан. Открой меню → 💎 Подписка.", reply_markup=main_menu_kb()); return
+        await _think_and_prepare(ctx, chat_id, lambda progress: solve_photo(ctx.bot, photo.file_id, caption, progress), ticket)
+    finally:
+        ticket.release()
+
+# ---------- Outbound rate limiter ----------
+class TokenBucket:
+    # резервирует токен сразу и возвращает, сколько ждать: очередь FIFO без локов
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.t = time.monotonic()
+
+    def _refill(self):
+        t = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (t - self.t) * self.rate)
+        self.t = t
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
 
-    if await is_premium(chat_id):
-        await _think_and_prepare(ctx, chat_id, lambda: solve_image_with_openai(file_url, caption)); return
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
 
-    day = today_key(); _, used_p = await get_usage(day, chat_id)
-    if used_p >= FREE_PHOTOS_PER_DAY:
-        await update.message.reply_text("Сегодня лимит по фото исчерпан. Открой меню → 💎 Подписка.", reply_markup=main_menu_kb()); return
+class _PendingEdit:
+    __slots__ = ("callback", "args", "kwargs", "future", "merged")
 
-    await inc_usage(day, chat_id, "photo")
-    await _think_and_prepare(ctx, chat_id, lambda: solve_image_with_openai(file_url, caption))
+    def __init__(self, callback, args, kwargs):
+        self.callback, self.args, self.kwargs = callback, args, kwargs
+        self.future = asyncio.get_running_loop().create_future()
+        self.merged = 0          # сколько вызовов ждут эту правку вместо своей
+
+class OutboundLimiter(BaseRateLimiter):
+    # все исходящие вызовы бота: общий бюджет (~30/с) и бюджет на чат, ожидающая правка
+    # сообщения заменяется более новой, повтор того же chat action в течение ACTION_TTL
+    # не отправляется, на RetryAfter — пауза для всех и повтор запроса
+    ACTION_TTL = 4.5   # Telegram показывает «печатает…» ~5 с
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float,
+                 group_rate: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chats: dict[int, TokenBucket] = {}
+        self._edits: dict[tuple, _PendingEdit] = {}
+        self._actions: dict[tuple, float] = {}
+        self._paused_until = 0.0
+        self.coalesced = 0
+        self.deduped = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10000:
+                for k in [k for k, v in self._chats.items() if v.idle()]:
+                    del self._chats[k]
+                t = time.monotonic()
+                for k in [k for k, ts in self._actions.items() if t - ts > self.ACTION_TTL]:
+                    del self._actions[k]
+            # группы: 20 сообщений в минуту
+            b = TokenBucket(self.group_rate, 3) if chat_id < 0 else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = b
+        return b
+
+    async def _budget(self, chat_id: Optional[int]):
+        if chat_id is None:
+            return
+        delay = max(self._chat_bucket(chat_id).reserve(), self.global_bucket.reserve())
+        delay = max(delay, self._paused_until - time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _send(self, chat_id: Optional[int], callback, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self._budget(chat_id)
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                ra = e.retry_after
+                ra = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+                self._paused_until = max(self._paused_until, time.monotonic() + ra + 0.1)
+                self.retries += 1
+
+    async def _send_edit(self, chat_id: Optional[int], pending: _PendingEdit, reraise: bool = True):
+        try:
+            res = await self._send(chat_id, pending.callback, pending.args, pending.kwargs)
+            pending.future.set_result(res)
+        except BaseException as e:
+            pending.future.set_exception(e); pending.future.exception()
+            if reraise:
+                raise
+            return None          # ошибку получат ждущие через future
+        return res
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # время включает ожидание бюджета: именно его видно в задержке ответа
+        with METRICS.timer("telegram", endpoint=endpoint):
+            return await self._process(callback, args, kwargs, endpoint, data)
+
+    async def _process(self, callback, args, kwargs, endpoint, data):
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        if not isinstance(chat_id, int):
+            chat_id = None
+
+        if endpoint == "sendChatAction" and chat_id is not None:
+            key = (chat_id, data.get("action"))
+            t = time.monotonic()
+            if t - self._actions.get(key, 0.0) < self.ACTION_TTL:
+                self.deduped += 1
+                return True
+            self._actions[key] = t
+
+        if endpoint == "editMessageText" and chat_id is not None and data.get("message_id"):
+            key = (chat_id, data["message_id"])
+            pending = self._edits.get(key)
+            if pending is not None:
+                # ещё не ушедшая правка того же сообщения: отправится уже наш текст
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                pending.merged += 1
+                self.coalesced += 1
+                return await asyncio.shield(pending.future)
+            pending = self._edits[key] = _PendingEdit(callback, args, kwargs)
+            try:
+                await self._budget(chat_id)
+            except BaseException:
+                self._edits.pop(key, None)
+                if pending.merged:
+                    # владельца отменили, пока он ждал бюджет, а в правку уже влились другие:
+                    # их текст отправляется отдельной задачей, иначе они ждали бы вечно
+                    _background(self._send_edit(chat_id, pending, reraise=False))
+                else:
+                    pending.future.cancel()
+                raise
+            self._edits.pop(key, None)
+            return await self._send_edit(None, pending)
+
+        return await self._send(chat_id, callback, args, kwargs)
+
+OUTBOUND = OutboundLimiter(
+    global_rate=float(os.getenv("TG_GLOBAL_RATE", "30")) / WEB_WORKERS,   # лимит Bot API общий на все процессы
+    chat_rate=float(os.getenv("TG_CHAT_RATE", "1")),
+    chat_burst=float(os.getenv("TG_CHAT_BURST", "3")),
+    group_rate=float(os.getenv("TG_GROUP_RATE", str(20 / 60))),
+    max_retries=int(os.getenv("TG_MAX_RETRIES", "3")),
+)
 
 # ---------- App ----------
-def build_app() -> Application:
-    app = ApplicationBuilder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(menu_router, pattern=r"^menu:(new|buy|ref|back)$"))
-    app.add_handler(CallbackQueryHandler(cb_buy, pattern=r"^buy:(day|week|month)$"))
-    app.add_handler(CallbackQueryHandler(cb_show_solution, pattern=r"^sol:show$"))
-    app.add_handler(PreCheckoutQueryHandler(precheckout))
-    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful))
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+METRICS.gauges(lambda: {
+    "solve_running": SCHEDULER._running, "solve_queued": SCHEDULER.queued(), "solve_shed_total": SCHEDULER.shed,
+    "render_pending": RENDER_POOL.pending,
+    "user_cache_hits_total": USER_CACHE.hits, "user_cache_misses_total": USER_CACHE.misses,
+    "answer_cache_hits_total": ANSWER_CACHE.hits, "answer_cache_misses_total": ANSWER_CACHE.misses,
+    "tg_edits_coalesced_total": OUTBOUND.coalesced, "tg_actions_deduped_total": OUTBOUND.deduped,
+    "tg_retry_after_total": OUTBOUND.retries, "usage_rolled_up_total": RETENTION.rolled_up,
+})
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    # апдейты одного чата обрабатываются строго по очереди, разные чаты — параллельно.
+    # Цена: следующее сообщение чата ждёт, пока закончится предыдущее (в т.ч. решение),
+    # и ожидающий апдейт занимает место в лимите max_concurrent_updates
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chats: dict[int, list] = {}     # chat_id -> [Lock, сколько апдейтов держат/ждут]
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine; return
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+CHAT_ORDERED = os.getenv("CHAT_ORDERED", "1") != "0"
+
+async def _post_init(app: Application):
+    # соединения с БД открываются в том же loop, где работает бот
+    await init_db()
+    USAGE.start(USAGE_FLUSH_SEC)
+    if WORKER_INDEX <= 0:           # при нескольких воркерах чистит только первый
+        RETENTION.start(USAGE_RETENTION_SEC)
+    # воркеры рендера и импорт openai — в фоне, чтобы не задерживать первый апдейт
+    RENDER_POOL.warm_up_in_background()
+    _background(warm_openai())
+
+_BG_TASKS: set[asyncio.Task] = set()
+
+def _background(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _BG_TASKS.add(task); task.add_done_callback(_BG_TASKS.discard)
+    return task
+
+async def _post_shutdown(app: Application):
+    await RETENTION.stop()
+    await USAGE.stop()   # досбросить счётчики до закрытия БД
+    await SOLUTIONS.flush()
+    await close_db()
+    RENDER_POOL.shutdown()
+    if oai_client:
+        await oai_client.close()
+    if _internal is not None:
+        await _internal.aclose()
+
+def build_app(request: Optional[BaseRequest] = None) -> Application:
+    builder = ApplicationBuilder()
+    if request is not None:           # bench.py подставляет фейковый Bot API
+        builder = builder.request(request).get_updates_request(request)
+    app = (builder.token(TOKEN)
+           # медленный solve не держит другие чаты; внутри чата — порядок прихода (CHAT_ORDERED)
+           .concurrent_updates(ChatOrderedProcessor(UPDATE_CONCURRENCY) if CHAT_ORDERED else UPDATE_CONCURRENCY)
+           .rate_limiter(OUTBOUND)
+           .post_init(_post_init)
+           .post_shutdown(_post_shutdown)
+           .build())
+    app.add_handler(CommandHandler("start", traced("start", start)))
+    app.add_handler(CallbackQueryHandler(traced("menu_router", menu_router), pattern=r"^menu:(new|buy|ref|back)$"))
+    app.add_handler(CallbackQueryHandler(traced("cb_buy", cb_buy), pattern=r"^buy:(day|week|month)$"))
+    app.add_handler(CallbackQueryHandler(traced("cb_show_solution", cb_show_solution), pattern=r"^sol:show$"))
+    app.add_handler(PreCheckoutQueryHandler(traced("precheckout", precheckout)))
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, traced("successful", successful)))
+    app.add_handler(MessageHandler(filters.PHOTO, traced("handle_photo", handle_photo)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, traced("handle_text", handle_text)))
     return app
 
+# ---------- Webhook server ----------
+import signal, sys
+import tornado.web
+
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, app: Application):
+        self.app = app
+
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400); return
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+        self.set_status(200)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(METRICS.render())
+
+FAST_START = os.getenv("FAST_START", "1") != "0"
+
+async def _ensure_webhook(bot, webhook_url: str):
+    if FAST_START:
+        # сервер уже принимает апдейты: вебхук не трогаем, если он и так наш, и не сбрасываем
+        # очередь — иначе потеряется как раз то сообщение, которое разбудило инстанс
+        info = await bot.get_webhook_info()
+        if info.url != webhook_url:
+            await bot.set_webhook(url=webhook_url)
+    else:
+        await bot.set_webhook(url=webhook_url, drop_pending_updates=True)
+
+async def _boot_app(app: Application, webhook_url: Optional[str]):
+    await app.initialize();          BOOT.mark("bot_init")
+    if app.post_init:
+        await app.post_init(app);    BOOT.mark("db_ready")
+    await app.start();               BOOT.mark("started")
+    if webhook_url:                  # воркеру вебхук не нужен — его ставит фронт
+        await _ensure_webhook(app.bot, webhook_url)
+        BOOT.mark("webhook_set")
+    BOOT.report()
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def serve_webhook(app: Application, routes: list, address: str, port: int, webhook_url: Optional[str]):
+    # свой tornado вместо run_webhook: рядом с вебхуком живёт /metrics.
+    # FAST_START: порт открывается сразу, апдейты копятся в update_queue, пока бот догружается
+    web = tornado.web.Application(routes + [(METRICS_PATH, MetricsHandler)])
+    stop = _stop_event()
+    if WORKER_INDEX >= 0:
+        _background(_watch_parent(stop))
+
+    if FAST_START:
+        server = web.listen(port, address=address, xheaders=True); BOOT.mark("listen")
+        boot = _background(_boot_app(app, webhook_url))
+        boot.add_done_callback(lambda t: t.cancelled() or t.exception() is None or stop.set())
+    else:
+        await _boot_app(app, webhook_url)
+        server = web.listen(port, address=address, xheaders=True); BOOT.mark("listen")
+    print(f"[BOOT] Listening on {address}:{port} (metrics at {METRICS_PATH})")
+    await stop.wait()
+
+    server.stop()
+    if FAST_START:
+        await boot          # упавшая загрузка пробрасывается отсюда
+    await app.stop()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    await app.shutdown()
+
+# ---------- Multi-process mode ----------
+# WEB_WORKERS>1: этот процесс — фронт. Он слушает PORT, ставит вебхук и отдаёт каждый апдейт
+# воркеру abs(chat_id) % WEB_WORKERS. Чат всегда живёт в одном процессе, поэтому его память
+# (дневные счётчики, очередь решений, кэш users) согласована. Апдейты чата попадают в update_queue
+# воркера в порядке прихода, а ChatOrderedProcessor обрабатывает их там по одному.
+# Общее между воркерами — SQLite в WAL (busy_timeout), решения пишутся в неё сразу.
+# Воркеры — этот же app.py с WORKER_INDEX, слушают 127.0.0.1:WORKER_PORT_BASE+i.
+FORWARD_TIMEOUT = float(os.getenv("WORKER_FORWARD_TIMEOUT", "10"))   # сколько ждать поднимающийся воркер
+
+_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+              "my_chat_member", "chat_member", "chat_join_request")
+
+def _shard_key(data: dict) -> int:
+    for k in _CHAT_KEYS:
+        if k in data:
+            return data[k]["chat"]["id"]
+    cq = data.get("callback_query")
+    if cq and cq.get("message"):
+        return cq["message"]["chat"]["id"]
+    # pre_checkout_query, inline_query и т.п. — по отправителю (в личке chat_id == user_id)
+    for v in data.values():
+        if isinstance(v, dict) and "from" in v:
+            return v["from"]["id"]
+    return 0
+
+def _owner(key: int) -> int:
+    return abs(key) % WEB_WORKERS
+
+def _worker_url(i: int, path: str) -> str:
+    return f"http://127.0.0.1:{WORKER_PORT_BASE + i}{path}"
+
+_internal: Optional[httpx.AsyncClient] = None
+
+def _internal_client() -> httpx.AsyncClient:
+    global _internal
+    if _internal is None:
+        _internal = httpx.AsyncClient(timeout=5.0)
+    return _internal
+
+async def _post_internal(i: int, path: str, **kwargs):
+    r = await _internal_client().post(_worker_url(i, path), **kwargs)
+    r.raise_for_status()
+
+def _invalidate_on_owner(user_id: int):
+    # запись в users из чужого воркера (бонус рефереру) сбрасывает кэш там, где живёт его чат
+    if WORKER_INDEX < 0 or _owner(user_id) == WORKER_INDEX:
+        return
+    async def send():
+        try:
+            await _post_internal(_owner(user_id), "/internal/invalidate", params={"user_id": user_id})
+        except httpx.HTTPError as e:     # не дошло — догонит USER_CACHE_TTL
+            print(f"[WORKER] invalidate {user_id} failed: {type(e).__name__}: {e}")
+    _background(send())
+
+class InvalidateHandler(tornado.web.RequestHandler):
+    def post(self):
+        USER_CACHE.invalidate(int(self.get_argument("user_id")))
+
+async def _watch_parent(stop: asyncio.Event):
+    # фронт убит без SIGTERM — воркер не должен остаться держать порт
+    parent = os.getppid()
+    while os.getppid() == parent:
+        await asyncio.sleep(2)
+    stop.set()
+
+class Dispatcher:
+    def __init__(self, n: int):
+        self.n = n
+        self._locks = [asyncio.Lock() for _ in range(n)]
+        self._procs: list[Optional[asyncio.subprocess.Process]] = [None] * n
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+
+    async def _supervise(self, i: int):
+        env = dict(os.environ, WORKER_INDEX=str(i))
+        while not self._stopping:
+            proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            self._procs[i] = proc
+            rc = await proc.wait()
+            if self._stopping:
+                break
+            METRICS.inc("worker_restarts_total", worker=i)
+            print(f"[FRONT] worker {i} exited with {rc}, restarting")
+            await asyncio.sleep(1)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._supervise(i)) for i in range(self.n)]
+
+    async def forward(self, data: dict, body: bytes) -> bool:
+        i = _owner(_shard_key(data))
+        deadline = time.monotonic() + FORWARD_TIMEOUT
+        # лок на воркер: апдейты уходят в его update_queue в порядке прихода на фронт
+        async with self._locks[i]:
+            while True:
+                try:
+                    with METRICS.timer("forward", worker=i):
+                        await _post_internal(i, "/internal/update", content=body,
+                                             headers={"Content-Type": "application/json"})
+                    return True
+                except httpx.HTTPError as e:    # воркер ещё стартует или перезапускается
+                    if time.monotonic() >= deadline:
+                        METRICS.inc("forward_failed_total", worker=i)
+                        print(f"[FRONT] worker {i} unavailable: {type(e).__name__}: {e}")
+                        return False
+                    await asyncio.sleep(0.2)
+
+    async def stop(self):
+        self._stopping = True
+        for proc in self._procs:
+            if proc is not None and proc.returncode is None:
+                proc.send_signal(signal.SIGTERM)
+        # воркеры досбрасывают счётчики и закрывают БД сами
+        await asyncio.gather(*self._tasks)
+
+class FrontHandler(tornado.web.RequestHandler):
+    def initialize(self, dispatcher: Dispatcher):
+        self.dispatcher = dispatcher
+
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400); return
+        if not isinstance(data, dict):
+            self.set_status(400); return
+        ok = await self.dispatcher.forward(data, self.request.body)
+        self.set_status(200 if ok else 503)     # на 503 Telegram повторит доставку
+
+class WorkerMetricsHandler(tornado.web.RequestHandler):
+    # метрики воркера i — отдельной целью для Prometheus: METRICS_PATH/i
+    async def get(self, i: str):
+        if int(i) >= WEB_WORKERS:
+            self.set_status(404); return
+        try:
+            r = await _internal_client().get(_worker_url(int(i), METRICS_PATH))
+        except httpx.HTTPError:
+            self.set_status(503); return
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(r.content)
+
+async def serve_front(webhook_path: str, webhook_url: str):
+    from telegram import Bot
+    dispatcher = Dispatcher(WEB_WORKERS)
+    web = tornado.web.Application([
+        (webhook_path, FrontHandler, {"dispatcher": dispatcher}),
+        (METRICS_PATH, MetricsHandler),
+        (METRICS_PATH + r"/(\d+)", WorkerMetricsHandler),
+    ])
+    stop = _stop_event()
+    server = web.listen(PORT, address="0.0.0.0", xheaders=True); BOOT.mark("listen")
+    # миграции — один раз и до воркеров, чтобы они не выполняли их наперегонки
+    await init_db(); await close_db()
+    dispatcher.start()
+    async with Bot(TOKEN) as bot:
+        await _ensure_webhook(bot, webhook_url)
+    BOOT.mark("webhook_set"); BOOT.report()
+    print(f"[FRONT] Listening on :{PORT}, {WEB_WORKERS} workers from :{WORKER_PORT_BASE}")
+    await stop.wait()
+
+    server.stop()
+    await dispatcher.stop()
+    if _internal is not None:
+        await _internal.aclose()
+
 def main():
-    asyncio.run(init_db())
-    app = build_app()
     webhook_path = os.getenv("WEBHOOK_PATH") or f"/webhook/{TOKEN.split(':')[0]}"
     webhook_url  = f"{PUBLIC_URL.rstrip('/')}{webhook_path}"
-    print(f"[BOOT] Setting webhook to: {webhook_url}")
-    try:
-        asyncio.get_running_loop()
-    except RuntimeError:
-        asyncio.set_event_loop(asyncio.new_event_loop())
-    app.run_webhook(
-        listen="0.0.0.0", port=PORT,
-        url_path=webhook_path, webhook_url=webhook_url,
-        drop_pending_updates=True, stop_signals=None,
-    )
+    if WORKER_INDEX >= 0:
+        app = build_app()
+        routes = [("/internal/update", WebhookHandler, {"app": app}), ("/internal/invalidate", InvalidateHandler)]
+        asyncio.run(serve_webhook(app, routes, "127.0.0.1", WORKER_PORT_BASE + WORKER_INDEX, None))
+    elif WEB_WORKERS > 1:
+        print(f"[BOOT] Setting webhook to: {webhook_url}")
+        asyncio.run(serve_front(webhook_path, webhook_url))
+    else:
+        app = build_app()
+        print(f"[BOOT] Setting webhook to: {webhook_url}")
+        asyncio.run(serve_webhook(app, [(webhook_path, WebhookHandler, {"app": app})], "0.0.0.0", PORT, webhook_url))
 
 if __name__ == "__main__":
     main()
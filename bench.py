@@ -0,0 +1,306 @@
+# ---------- Offline load test ----------
+# Гоняет хендлеры app.py без Telegram и OpenAI: Bot API и модель — локальные фейки
+# с настраиваемой задержкой, апдейты синтетические, приложение собирается через build_app.
+#
+#   python bench.py --updates 2000 --concurrency 64 --openai-ms 800 --tg-ms 40
+#
+import os, io, json, time, random, asyncio, argparse, shutil, tempfile, contextlib, types
+
+# временная БД — только в главном процессе: forkserver пула рендера импортирует этот модуль
+# заново, но уже с DB_PATH в окружении
+_tmp = None
+if "DB_PATH" not in os.environ:
+    _tmp = tempfile.mkdtemp(prefix="gdz-bench-")
+    os.environ["DB_PATH"] = os.path.join(_tmp, "bench.sqlite3")
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:bench")
+os.environ.setdefault("PUBLIC_URL", "http://localhost")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import app
+from telegram import Update
+from telegram.request import BaseRequest
+
+def _pct(xs: list[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+class Stats:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+
+    def add(self, name: str, sec: float):
+        self.samples.setdefault(name, []).append(sec)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t)
+
+STATS = Stats()
+
+# ---------- fake Bot API ----------
+def _sample_jpeg() -> bytes:
+    from PIL import Image, ImageDraw
+    rnd = random.Random(7)
+    img = Image.new("RGB", (1280, 960), (240, 235, 220)); d = ImageDraw.Draw(img)
+    for _ in range(400):
+        x, y = rnd.randrange(1200), rnd.randrange(900)
+        d.rectangle((x, y, x + rnd.randrange(5, 60), y + rnd.randrange(5, 30)), fill=(rnd.randrange(100),) * 3)
+    buf = io.BytesIO(); img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+class FakeBotRequest(BaseRequest):
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self.last_status: dict[int, int] = {}   # chat_id -> message_id статус-сообщения
+        self._msg_id = 0
+        self._photo = _sample_jpeg()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._msg_id += 1
+        return {"message_id": self._msg_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if "/file/" in url:
+            return 200, self._photo
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        p = request_data.parameters if request_data else {}
+        chat_id = p.get("chat_id", 0)
+        if endpoint == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint == "sendMessage":
+            result = self._message(chat_id, text=p.get("text", ""))
+            if result["text"].startswith("🤔"):
+                self.last_status[int(chat_id)] = result["message_id"]
+        elif endpoint == "editMessageText":
+            result = self._message(chat_id, text=p.get("text", ""))
+            result["message_id"] = p.get("message_id")
+        elif endpoint == "sendPhoto":
+            self._msg_id += 1
+            result = self._message(chat_id, photo=[{"file_id": f"photo{self._msg_id}", "file_unique_id": f"u{self._msg_id}",
+                                                    "width": 1, "height": 1}])
+        elif endpoint == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif endpoint == "getFile":
+            result = {"file_id": p.get("file_id"), "file_unique_id": "u" + str(p.get("file_id")),
+                      "file_path": f"photos/{p.get('file_id')}.jpg"}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# ---------- fake OpenAI ----------
+class FakeOpenAI:
+    def __init__(self, latency: float, chunks: int):
+        self.latency = latency
+        self.chunks = chunks
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def _answer(self, kwargs) -> str:
+        content = kwargs["messages"][-1]["content"]
+        task = content if isinstance(content, str) else "фото"
+        return ("Дано: " + task + "\nРешение:\n1) \\frac{3}{4} + \\frac{1}{4} = 1\n"
+                "2) 12 × 3 ÷ 4 = 9\n3) x^{2} = 81, x = 9\nОтвет: 9")
+
+    async def create(self, timeout=None, stream=False, **kwargs):
+        self.calls += 1
+        text = self._answer(kwargs)
+        if not stream:
+            await asyncio.sleep(self.latency)
+            msg = types.SimpleNamespace(content=text)
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=msg, finish_reason="stop")])
+        step = max(1, len(text) // self.chunks)
+        async def gen():
+            for i in range(0, len(text), step):
+                await asyncio.sleep(self.latency / self.chunks)
+                delta = types.SimpleNamespace(content=text[i:i + step])
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta, finish_reason=None)])
+            done = types.SimpleNamespace(content=None)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=done, finish_reason="stop")])
+        return gen()
+
+    async def close(self):
+        pass
+
+# ---------- instrumentation ----------
+def _instrument(fake_render_ms: float | None):
+    db = app.Database
+    fetchone, fetchall, transaction = db.fetchone, db.fetchall, db.transaction
+
+    async def t_fetchone(self, *a, **k):
+        with STATS.timer("db"):
+            return await fetchone(self, *a, **k)
+
+    async def t_fetchall(self, *a, **k):
+        with STATS.timer("db"):
+            return await fetchall(self, *a, **k)
+
+    @contextlib.asynccontextmanager
+    async def t_transaction(self):
+        with STATS.timer("db"):
+            async with transaction(self) as conn:
+                yield conn
+
+    db.fetchone, db.fetchall, db.transaction = t_fetchone, t_fetchall, t_transaction
+
+    render = app.render_answer_png
+    async def t_render(text: str) -> bytes:
+        with STATS.timer("render"):
+            if fake_render_ms is not None:
+                await asyncio.sleep(fake_render_ms / 1000)
+                return b"\x89PNG bench"
+            return await render(text)
+    app.render_answer_png = t_render
+
+# ---------- synthetic updates ----------
+class Traffic:
+    def __init__(self, args, bot, req: FakeBotRequest):
+        self.args = args
+        self.bot = bot
+        self.req = req
+        self.rnd = random.Random(args.seed)
+        self._uid = 0
+
+    def _next_id(self) -> int:
+        self._uid += 1
+        return self._uid
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+    def _msg(self, uid: int, **extra) -> dict:
+        return {"message_id": self._next_id(), "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"}, "from": self._user(uid), **extra}
+
+    def text(self, uid: int) -> Update:
+        n = self.rnd.randrange(self.args.distinct_prompts)
+        return Update.de_json({"update_id": self._next_id(),
+                               "message": self._msg(uid, text=f"Вычисли {n} × 3 + {n} ÷ 2")}, self.bot)
+
+    def photo(self, uid: int) -> Update:
+        fid = f"ph{self.rnd.randrange(self.args.distinct_prompts)}"
+        photo = [{"file_id": fid, "file_unique_id": "u" + fid, "width": 1280, "height": 960}]
+        return Update.de_json({"update_id": self._next_id(),
+                               "message": self._msg(uid, photo=photo, caption="реши")}, self.bot)
+
+    def show(self, uid: int) -> Update:
+        mid = self.req.last_status.get(uid, 1)
+        msg = {"message_id": mid, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "text": "✅"}
+        return Update.de_json({"update_id": self._next_id(), "callback_query": {
+            "id": str(self._next_id()), "from": self._user(uid), "chat_instance": "bench",
+            "data": "sol:show", "message": msg}}, self.bot)
+
+    def pay(self, uid: int) -> Update:
+        sp = {"currency": "XTR", "total_amount": app.PRICE_DAY, "invoice_payload": f"prem:{uid}:1:{int(time.time())}",
+              "telegram_payment_charge_id": f"bench{self._next_id()}", "provider_payment_charge_id": "bench"}
+        return Update.de_json({"update_id": self._next_id(),
+                               "message": self._msg(uid, successful_payment=sp)}, self.bot)
+
+async def _feed(application, upd: Update, kind: str):
+    t = time.perf_counter()
+    try:
+        await application.process_update(upd)
+    finally:
+        STATS.add(kind, time.perf_counter() - t)
+
+async def _session(application, traffic: Traffic, uid: int):
+    a = traffic.args; rnd = traffic.rnd
+    if rnd.random() < a.photo_share:
+        await _feed(application, traffic.photo(uid), "handle_photo")
+    else:
+        await _feed(application, traffic.text(uid), "handle_text")
+    if rnd.random() < a.show_share:
+        await _feed(application, traffic.show(uid), "cb_show_solution")
+    if rnd.random() < a.pay_share:
+        await _feed(application, traffic.pay(uid), "successful")
+
+async def run(args) -> None:
+    _instrument(args.fake_render_ms)
+    req = FakeBotRequest(args.tg_ms / 1000)
+    fake_oai = FakeOpenAI(args.openai_ms / 1000, args.stream_chunks)
+    app.oai_client = fake_oai
+    application = app.build_app(request=req)
+    traffic = Traffic(args, application.bot, req)
+
+    await application.initialize()
+    await application.post_init(application)
+    if args.fake_render_ms is None:
+        await app.RENDER_POOL.warm_up()
+    await application.start()
+    STATS.samples.clear()
+
+    users = list(range(1, args.users + 1))
+    for uid in users[: int(len(users) * args.premium_share)]:
+        await app.ensure_user(uid); await app.add_premium_days(uid, 30)
+
+    sem = asyncio.Semaphore(args.concurrency)
+    async def one():
+        async with sem:
+            await _session(application, traffic, traffic.rnd.choice(users))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.updates)))
+    wall = time.perf_counter() - t0
+
+    await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+    _report(args, wall, req, fake_oai)
+    if _tmp:
+        shutil.rmtree(_tmp, ignore_errors=True)   # БД прогона больше не нужна
+
+def _report(args, wall: float, req: FakeBotRequest, fake_oai: FakeOpenAI):
+    handlers = ["handle_text", "handle_photo", "cb_show_solution", "successful"]
+    total = sum(len(STATS.samples.get(h, [])) for h in handlers)
+    print(f"\nconcurrency={args.concurrency} openai={args.openai_ms}ms tg={args.tg_ms}ms "
+          f"wall={wall:.2f}s updates={total} → {total / wall:.1f} updates/s\n")
+    print(f"{'stage':<18}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'total s':>10}")
+    for name in handlers + ["db", "render"]:
+        xs = STATS.samples.get(name, [])
+        if xs:
+            print(f"{name:<18}{len(xs):>7}{_pct(xs, 50) * 1e3:>10.1f}{_pct(xs, 95) * 1e3:>10.1f}"
+                  f"{_pct(xs, 99) * 1e3:>10.1f}{sum(xs):>10.2f}")
+    print(f"\nopenai calls: {fake_oai.calls}   bot api calls: {sum(req.calls.values())} {req.calls}")
+    print(f"answer cache: {app.ANSWER_CACHE.stats()}   user cache: {app.USER_CACHE.stats()}")
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline load test for the bot handlers")
+    ap.add_argument("--updates", type=int, default=500, help="user sessions (text/photo + optional show/pay)")
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--premium-share", type=float, default=0.2)
+    ap.add_argument("--photo-share", type=float, default=0.3)
+    ap.add_argument("--show-share", type=float, default=0.8)
+    ap.add_argument("--pay-share", type=float, default=0.02)
+    ap.add_argument("--distinct-prompts", type=int, default=300, help="меньше — выше доля попаданий в кэш ответов")
+    ap.add_argument("--openai-ms", type=float, default=500)
+    ap.add_argument("--stream-chunks", type=int, default=20)
+    ap.add_argument("--tg-ms", type=float, default=30)
+    ap.add_argument("--fake-render-ms", type=float, default=None, help="не запускать matplotlib, а ждать столько мс")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
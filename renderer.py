@@ -0,0 +1,297 @@
+# ---------- PNG renderer (выполняется в процессах пула) ----------
+# Модуль импортируется воркерами пула: шрифты и matplotlib настраиваются
+# один раз в _init_worker, а не на каждую картинку.
+#
+# Движки: обычные строки и «лёгкая» математика (×, ÷, ≥, простые \frac, степени)
+# рисуются Pillow прямо на холсте; matplotlib mathtext вызывается только для строк,
+# где без него не обойтись (\sqrt, \int, \sum, вложенные конструкции).
+# RENDER_ENGINE=mpl возвращает старый рендер целиком через matplotlib.
+import io, os, re, textwrap
+import importlib.util
+from functools import lru_cache
+
+RENDERER_VERSION = 3
+
+RENDER_ENGINE = os.getenv("RENDER_ENGINE", "auto")     # auto | mpl
+RENDER_FORMAT = os.getenv("RENDER_FORMAT", "png")      # png | webp
+CANVAS_W  = 1280          # Telegram всё равно ужимает фото до 1280 по большей стороне
+MARGIN    = 56
+FONT_PX   = 30
+LINE_GAP  = 0.45          # межстрочный интервал, доля кегля
+
+F_FRACTION = re.compile(r'(?<![\w\\])([A-Za-z0-9]+)\s*/\s*([A-Za-z0-9]+)(?![\w\\])')
+def _to_math_fractions(s: str) -> str:
+    #  a/b  -> \frac{a}{b}
+    return F_FRACTION.sub(r'\\frac{\1}{\2}', s)
+
+def _latexish_cleanup(s: str) -> str:
+    # убрать все видимые $ и окружения \[ \]
+    s = s.replace("\\[","").replace("\\]","").replace("\\(","").replace("\\)","")
+    s = s.replace("$$","").replace("$","")
+    return s
+
+def _normalize_ops(line: str) -> str:
+    return (line
+            .replace("\\cdot","·")
+            .replace("\\times","×")
+            .replace("*","·")
+            .replace("/", "÷")  # простое деление в текстовых линиях
+            .replace(">=", "≥").replace("<=", "≤")
+            )
+
+# ---- определить что это «математика» (рендерить PNG), а не сочинение
+MATH_RE = re.compile(r'(?=.*\d)(?=.*[+\-*/×÷=^])', re.S)
+def _is_math(text: str) -> bool:
+    t = text or ""
+    letters = sum(ch.isalpha() for ch in t)
+    ops     = sum(ch in "+-*/×÷=^" for ch in t)
+    if letters > 600 and ops < 5:  # длинное эссе — текстом
+        return False
+    return bool(MATH_RE.search(t)) or any(k in t for k in ["\\frac","\\sqrt","^{","_{"])
+
+MATH_TOKENS = ["\\frac","\\sqrt","^{","_{","\\int","\\sum"]
+
+# «лёгкие» конструкции, которые Pillow рисует сам
+F_LIGHT = re.compile(r'\\frac\{([^{}\\]*)\}\{([^{}\\]*)\}|\^\{([^{}\\]*)\}|_\{([^{}\\]*)\}|\^(\w)')
+
+def _line_engine(raw: str) -> str:
+    # text — обычная строка (переносится по ширине), light — Pillow с дробями/степенями,
+    # mathtext — только matplotlib
+    if not any(tok in raw for tok in MATH_TOKENS) and not _is_math(raw):
+        return "text"
+    rest = F_LIGHT.sub("", raw).replace("\\cdot", "").replace("\\times", "")
+    if "\\" in rest or "{" in rest or "}" in rest:
+        return "mathtext"
+    return "light" if any(tok in raw for tok in MATH_TOKENS) or "^" in raw else "text"
+
+# ---------- Pillow ----------
+def _font_path() -> str | None:
+    env = os.getenv("RENDER_FONT")
+    if env:
+        return env
+    candidates = ["/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"]
+    spec = importlib.util.find_spec("matplotlib")   # шрифт из matplotlib без импорта самого matplotlib
+    if spec and spec.submodule_search_locations:
+        candidates.insert(0, os.path.join(spec.submodule_search_locations[0], "mpl-data", "fonts", "ttf", "DejaVuSans.ttf"))
+    return next((p for p in candidates if os.path.exists(p)), None)
+
+@lru_cache(maxsize=None)
+def _font(px: int):
+    from PIL import ImageFont
+    path = _font_path()
+    return ImageFont.truetype(path, px) if path else ImageFont.load_default(px)
+
+@lru_cache(maxsize=8192)
+def _width(s: str, px: int) -> float:
+    return _font(px).getlength(s)
+
+@lru_cache(maxsize=2048)
+def _wrap(line: str, px: int, max_w: int) -> tuple[str, ...]:
+    out, cur = [], ""
+    for word in line.split(" "):
+        cand = f"{cur} {word}" if cur else word
+        if cur and _width(cand, px) > max_w:
+            out.append(cur); cur = word
+        else:
+            cur = cand
+    out.append(cur)
+    return tuple(out)
+
+_WORDS = re.compile(r"\S+\s*|\s+")
+
+def _text_segs(t: str, px: int) -> list:
+    # по слову на сегмент (с хвостовым пробелом) — чтобы строку можно было переносить
+    return [("text", _width(w, px), w) for w in _WORDS.findall(t)]
+
+@lru_cache(maxsize=2048)
+def _segments(line: str, px: int, max_w: int) -> tuple:
+    # разбор light-строки: (вид, ширина, поля); вертикаль считается от базовой линии.
+    # -> строки холста: переносим по пробелам, дробь/степень не отрываем от соседнего слова
+    small = int(px * 0.78)
+    segs, pos = [], 0
+    for m in F_LIGHT.finditer(line):
+        if m.start() > pos:
+            segs.extend(_text_segs(_normalize_ops(line[pos:m.start()]), px))
+        num, den, sup, sub, sup1 = m.groups()
+        if num is not None:
+            num, den = _normalize_ops(num), _normalize_ops(den)
+            w = max(_width(num, small), _width(den, small)) + px * 0.3
+            segs.append(("frac", w, num, den))
+        elif sub is not None:
+            segs.append(("sub", _width(sub, small), sub))
+        else:
+            s = sup if sup is not None else sup1
+            segs.append(("sup", _width(s, small), s))
+        pos = m.end()
+    if pos < len(line):
+        segs.extend(_text_segs(_normalize_ops(line[pos:]), px))
+
+    rows, cur, cur_w = [], [], 0.0
+    for seg in segs:
+        breakable = bool(cur) and cur[-1][0] == "text" and cur[-1][2].endswith(" ")
+        if breakable and cur_w + seg[1] > max_w:
+            rows.append(tuple(cur)); cur, cur_w = [], 0.0
+            if seg[0] == "text" and not seg[2].strip():
+                continue                       # пробел в начале новой строки не нужен
+        cur.append(seg); cur_w += seg[1]
+    if cur:
+        rows.append(tuple(cur))
+    return tuple(rows)
+
+def _line_box(kind: str, px: int) -> tuple[int, int]:
+    # (над базовой линией, под ней)
+    asc, desc = _font(px).getmetrics()
+    if kind == "light":
+        return int(asc + px * 0.75), int(desc + px * 0.75)
+    return asc, desc
+
+def _mathtext_image(raw: str, px: int):
+    from PIL import Image
+    if _plt is None:
+        _init_mpl()          # rcParams mathtext — до первого math_to_image
+    from matplotlib import mathtext
+    from matplotlib.font_manager import FontProperties
+    buf = io.BytesIO()
+    raw = raw.replace(" ", "\\ ")    # mathtext съедает пробелы между словами
+    mathtext.math_to_image(f"${raw}$", buf, prop=FontProperties(family="DejaVu Sans", size=px * 0.72 * 1.1),
+                           dpi=100, format="png")
+    buf.seek(0)
+    img = Image.open(buf).convert("RGBA")
+    bg = Image.new("RGBA", img.size, (255, 255, 255, 255))
+    return Image.alpha_composite(bg, img).convert("L")
+
+def _draw_light(draw, x: float, base: int, segs: tuple, px: int):
+    small = int(px * 0.78); f, fs = _font(px), _font(small)
+    axis = base - px * 0.3                          # ось дроби ~ середина строчных букв
+    for seg in segs:
+        kind, w = seg[0], seg[1]
+        if kind == "text":
+            draw.text((x, base), seg[2], font=f, fill=0, anchor="ls")
+        elif kind == "frac":
+            num, den = seg[2], seg[3]
+            draw.text((x + (w - _width(num, small)) / 2, axis - px * 0.12), num, font=fs, fill=0, anchor="ld")
+            draw.line((x + px * 0.1, axis, x + w - px * 0.1, axis), fill=0, width=max(1, px // 15))
+            draw.text((x + (w - _width(den, small)) / 2, axis + px * 0.12), den, font=fs, fill=0, anchor="la")
+        elif kind == "sup":
+            draw.text((x, base - px * 0.45), seg[2], font=fs, fill=0, anchor="ls")
+        else:
+            draw.text((x, base + px * 0.25), seg[2], font=fs, fill=0, anchor="ls")
+        x += w
+
+def render_pillow(text: str) -> bytes:
+    from PIL import Image, ImageDraw
+    px = FONT_PX; max_w = CANVAS_W - 2 * MARGIN; gap = int(px * LINE_GAP)
+    text = _to_math_fractions(_latexish_cleanup(text))
+
+    rows = []   # (kind, payload, above, below)
+    for raw in text.splitlines():
+        raw = raw.rstrip()
+        if not raw:
+            rows.append(("blank", None, 0, px // 2)); continue
+        kind = _line_engine(raw)
+        if kind == "text":
+            for part in _wrap(_normalize_ops(raw), px, max_w):
+                rows.append(("text", part, *_line_box("text", px)))
+        elif kind == "light":
+            for part in _segments(raw, px, max_w):
+                # высокий интервал нужен только строкам с дробями
+                box = _line_box("light" if any(seg[0] == "frac" for seg in part) else "text", px)
+                rows.append(("light", part, *box))
+        else:
+            try:
+                img = _mathtext_image(raw, px)
+            except ValueError:
+                # mathtext не разобрал строку (неизвестная команда и т.п.) — рисуем её как текст
+                for part in _wrap(_normalize_ops(raw), px, max_w):
+                    rows.append(("text", part, *_line_box("text", px)))
+                continue
+            if img.width > max_w:
+                img = img.resize((max_w, max(1, img.height * max_w // img.width)), Image.Resampling.LANCZOS)
+            rows.append(("image", img, img.height, 0))
+
+    height = 2 * MARGIN + sum(a + b + gap for _, _, a, b in rows)
+    canvas = Image.new("L", (CANVAS_W, max(height, 2 * MARGIN + px)), 255)
+    draw = ImageDraw.Draw(canvas)
+    y = MARGIN
+    for kind, payload, above, below in rows:
+        base = y + above
+        if kind == "text":
+            draw.text((MARGIN, base), payload, font=_font(px), fill=0, anchor="ls")
+        elif kind == "light":
+            _draw_light(draw, MARGIN, base, payload, px)
+        elif kind == "image":
+            canvas.paste(payload, (MARGIN, y))
+        y += above + below + gap
+
+    buf = io.BytesIO()
+    if RENDER_FORMAT == "webp":
+        canvas.save(buf, format="WEBP", lossless=True, method=4)
+    else:
+        canvas.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+# ---------- matplotlib (RENDER_ENGINE=mpl) ----------
+_plt = None
+
+def _init_mpl():
+    global _plt
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    plt.rcParams.update({
+        "font.size": 12,
+        "font.family": "DejaVu Sans",
+        "mathtext.fontset": "dejavusans",
+    })
+    _plt = plt
+
+def render_mpl(text: str) -> bytes:
+    if _plt is None:
+        _init_mpl()
+    plt = _plt
+
+    # чистим, ставим \frac, аккуратно оборачиваем math-строки в $
+    text = _latexish_cleanup(text)
+    text = _to_math_fractions(text)
+
+    lines = []
+    for raw in text.splitlines():
+        raw = raw.rstrip()
+        if not raw:
+            lines.append("")
+            continue
+        if any(tok in raw for tok in MATH_TOKENS):
+            lines.append(f"${raw}$")  # mathtext
+        else:
+            lines.extend(textwrap.wrap(_normalize_ops(raw), width=86) or [""])
+
+    # широкое полотно; высота — по количеству строк
+    height = max(1.2, 0.55 + 0.30 * len(lines))
+    fig = plt.figure(figsize=(10.5, height), dpi=200)
+    ax = fig.add_axes([0,0,1,1]); ax.axis("off")
+
+    y = 0.96
+    for line in lines:
+        ax.text(0.05, y, line, va="top", ha="left", wrap=True)
+        y -= 0.042
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight", pad_inches=0.35)
+    plt.close(fig); buf.seek(0)
+    return buf.getvalue()
+
+def _init_worker():
+    # auto-движку matplotlib нужен лишь для редких mathtext-строк — он импортируется при первой
+    # такой строке, а не в каждом воркере на старте. Прогрев грузит шрифты и Pillow
+    if RENDER_ENGINE == "mpl":
+        _init_mpl()
+    render_png("Прогрев: 1/2 × 3 = 1,5\nx^{2} = 4")
+
+def render_png(text: str) -> bytes:
+    if RENDER_ENGINE == "mpl":
+        return render_mpl(text)
+    return render_pillow(text)
+
+def ping() -> int:
+    # пустая задача: заставляет пул поднять воркер заранее
+    return RENDERER_VERSION
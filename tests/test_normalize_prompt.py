@@ -0,0 +1,22 @@
+import os, sys
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123:abc")
+os.environ.setdefault("PUBLIC_URL", "https://example.invalid")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app import normalize_prompt
+
+
+def test_superscripts_are_not_folded_into_digits():
+    assert normalize_prompt("Вычисли 5² + 3²") != normalize_prompt("Вычисли 52 + 32")
+    assert normalize_prompt("Вычисли 5² + 3²") == normalize_prompt("вычисли 5^2 + 3^2")
+
+
+def test_subscripts_are_not_folded_into_digits():
+    assert normalize_prompt("x₁ + x₂") != normalize_prompt("x1 + x2")
+    assert normalize_prompt("x₁ + x₂") == normalize_prompt("x_1+x_2")
+
+
+def test_operator_variants_and_spacing_are_canonical():
+    assert normalize_prompt("2 × 3 ÷ 4 − 1") == normalize_prompt("2*3/4-1")
+    assert normalize_prompt("  Реши   2·3 ") == "реши 2*3"